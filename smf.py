@@ -12,15 +12,22 @@ import math
 import gzip
 import bz2
 import struct
+import array
+import mmap
+import bisect
 import binascii
 import pprint
 import base64
 import hashlib
 import tempfile
+import sqlite3
 import platform
 import threading
+import itertools
+import select
 import subprocess as sp
 from datetime import datetime
+from collections import deque
 
 
 """smf.py: file undupe by sizematching files in folders"""
@@ -56,16 +63,38 @@ if PY2:
 	from Queue import Queue
 
 	input = raw_input
+
+	def intern(txt):
+		return txt  # only takes bytestrings on py2
 else:
 	import builtins
 	from queue import Queue
+	from sys import intern
+
+# array typecodes for 64-bit ints; py2 has no q/Q but l/L are 64-bit,
+# except on windows which gets doubles instead (exact below 2**53)
+if not PY2:
+	I64, U64 = 'q', 'Q'
+elif array.array('l').itemsize == 8:
+	I64, U64 = 'l', 'L'
+else:
+	I64 = U64 = 'd'
+
+try:
+	import numpy as np
+except ImportError:
+	np = None
 
 
 if not WINDOWS:
 	TERM_ENCODING = sys.stdout.encoding
 
 	import tty, termios
-	def getch():
+	def getch(timeout=None, waker=None):
+		"""
+		one keypress, or None if timeout expired or
+		the waker was poked (by the hashing threads) first
+		"""
 		ch = 0
 		fd = sys.stdin.fileno()
 		old_cfg = termios.tcgetattr(fd)
@@ -74,8 +103,18 @@ if not WINDOWS:
 		try:
 			# tty.setraw(fd)
 			termios.tcsetattr(fd, termios.TCSADRAIN, tmp_cfg)
-			ch = sys.stdin.read(1)
 			sys.stdout.flush()
+			fds = [fd] + ([waker.rfd] if waker else [])
+			if fd not in select.select(fds, [], [], timeout)[0]:
+				return None
+			
+			# unbuffered, or select would miss whatever sys.stdin read ahead
+			ch = os.read(fd, 1)
+			lead = bytearray(ch)[0] if ch else 0
+			for _ in range((lead >= 0xc0) + (lead >= 0xe0) + (lead >= 0xf0)):
+				ch += os.read(fd, 1)
+			
+			ch = ch.decode(TERM_ENCODING or 'utf-8', 'replace')
 		finally:
 			termios.tcsetattr(fd, termios.TCSADRAIN, old_cfg)
 		return ch
@@ -122,9 +161,21 @@ else:
 		FS_ENCODING = 'utf-8'  # pypy bug: thinks we are mbcs
 
 	import msvcrt  # pylint: disable=import-error
-	def getch():
-		while msvcrt.kbhit():
-			msvcrt.getch()
+	def getch(timeout=None, waker=None):
+		if timeout is None and not waker:
+			while msvcrt.kbhit():
+				msvcrt.getch()
+		else:
+			# no select() on console handles, so poll
+			t_end = time.time() + (timeout or 0)
+			while not msvcrt.kbhit():
+				if waker and waker.evt.wait(0.05):
+					return None
+				elif not waker:
+					time.sleep(0.05)
+				
+				if timeout is not None and time.time() > t_end:
+					return None
 		
 		rv = msvcrt.getch()
 		try:
@@ -249,13 +300,20 @@ def print(*args, **kwargs):
 		builtins.print(termsafe(' '.join(str(x) for x in args)), **kwargs)
 
 
+def mtime_ns(sr):
+	try:
+		return sr.st_mtime_ns
+	except AttributeError:
+		return int(sr.st_mtime * 1000000000)
+
+
 def _statdir_bytes(logger, top, lstat):
 	"""non-recursive listing of directory contents, along with stat() info"""
 	if lstat and ANYWIN:
 		lstat = False
 
 	scandir = hasattr(os, "scandir")
-	if lstat and not os.supports_follow_symlinks:
+	if scandir and lstat and not os.supports_follow_symlinks:
 		scandir = False
 
 	if scandir:
@@ -295,23 +353,155 @@ def _statdir_as_unicode(logger, top, lstat):
 statdir = _statdir_as_unicode if PY2 and ANYWIN and PYPY else _statdir_bytes
 
 
+class PathTable(object):
+	"""
+	interned paths; each path is the id of its parent plus its last
+	component, with the components interned, so a deep tree keeps each
+	directory name once instead of every path repeating its parents
+	"""
+	def __init__(self):
+		self.mtx = threading.Lock()
+		self.reset()
+	
+	def reset(self):
+		"""forget all paths; ids handed out before are invalid after this"""
+		with self.mtx:
+			self.parents = array.array('l')  # -1 = toplevel
+			self.names = []
+			self.ids = {}  # (parent, name): id
+			self.last = (None, -1)  # parent of the previous add
+	
+	def child(self, parent, name):
+		"""id of name within the parent id"""
+		with self.mtx:
+			return self._child(parent, name)
+	
+	def _child(self, parent, name):
+		key = (parent, name)
+		try:
+			return self.ids[key]
+		except KeyError:
+			pass
+		
+		ret = self.ids[key] = len(self.names)
+		self.parents.append(parent)
+		self.names.append(intern(name))
+		return ret
+	
+	def add(self, path):
+		"""id of the path, adding it (and its parents) if new"""
+		with self.mtx:
+			return self._add(path)
+	
+	def _add(self, path):
+		try:
+			parent_path, name = path.rsplit(os.sep, 1)
+		except ValueError:
+			return self._child(-1, path)
+		
+		# siblings tend to come in a row
+		if self.last[0] == parent_path:
+			parent = self.last[1]
+		else:
+			parent = self._add(parent_path)
+			self.last = (parent_path, parent)
+		
+		return self._child(parent, name)
+	
+	def path(self, pid):
+		names = []
+		while pid >= 0:
+			names.append(self.names[pid])
+			pid = self.parents[pid]
+		
+		return os.sep.join(reversed(names))
+
+
+PATHS = PathTable()
+
+
 class Folder(object):
 	"""
-	the absolute path to a folder, and
+	the absolute path to a folder (as an id in PATHS), and
 	the size of each file directly within
+	(sorted ascending, with the count and sum cached for the matcher);
+	when scanned from disk also the device, and the inode, link count
+	and allocated bytes of each file (in the same order as the sizes).
+	src is which of the folders given as arguments it was found in.
+	Kept small since there can be millions; arrays instead of lists,
+	and the hashes/samples dicts are only created when used
 	"""
-	def __init__(self, path):
-		self.path = path
-		self.files = []
-		self.hashes = {}
+	__slots__ = ['pid', 'src', 'dev', 'files', 'nfiles', 'nbytes',
+		'inos', 'nlinks', 'allocs', '_hashes', '_samples']
+	
+	def __init__(self, path, files=(), dev=0, inos=(), nlinks=(), allocs=(),
+		src=0, presorted=False):
+		"""path may also be its id in PATHS"""
+		self.pid = path if isinstance(path, int) else PATHS.add(path)
+		self.src = src
+		self.dev = dev
+		if presorted:
+			pass
+		elif inos:
+			files, inos, nlinks, allocs = zip(*sorted(
+				zip(files, inos, nlinks, allocs)))
+		else:
+			files = sorted(files)
+		
+		self.files = array.array(U64, files)
+		self.nfiles = len(self.files)
+		self.nbytes = int(sum(self.files))
+		if inos:
+			self.inos = array.array(U64, inos)
+			self.nlinks = array.array('I', nlinks)
+			self.allocs = array.array(U64, allocs)
+		else:
+			self.inos = self.nlinks = self.allocs = ()
+		
+		self._hashes = None
+		self._samples = None
+	
+	@property
+	def path(self):
+		return PATHS.path(self.pid)
+	
+	@property
+	def hashes(self):
+		"""{fname: (sz, ts, hash)} of files within"""
+		if self._hashes is None:
+			self._hashes = {}
+		
+		return self._hashes
+	
+	@hashes.setter
+	def hashes(self, hashes):
+		self._hashes = hashes
+	
+	@property
+	def samples(self):
+		"""{fname: hash of the sampled blocks}"""
+		if self._samples is None:
+			self._samples = {}
+		
+		return self._samples
+	
+	def has_hashes(self):
+		"""like bool(hashes) without creating it"""
+		return bool(self._hashes)
 	
 	def __str__(self):
 		return '\033[36m{:6} \033[35m{:12}\033[0m {}'.format(
-			len(self.files), sum(self.files), self.path)
+			self.nfiles, self.nbytes, self.path)
 
 
 class DiskWalker(object):
-	def __init__(self, top):
+	def __init__(self, top, nthreads=1, prev=None):
+		"""
+		prev is the previous snapshot of this tree as given by snapshot_index;
+		the directories walked go into dirs as (path id, (inode, mtime)),
+		or (path id, None) if they could not be listed completely;
+		directories with the same inode and mtime are not listed again
+		"""
 		if ':' in top and top.endswith('rfl'):
 			self.from_rfl(top)
 			return
@@ -323,6 +513,9 @@ class DiskWalker(object):
 		self.cur_top = top
 		self.folders = []
 		self.errors = []
+		self.dirs = []
+		self.prev = prev or {}
+		self.nreused = 0
 		
 		self.re_usenet = r'\.(r[0-9]{2}|part[0-9]+\.rar)$'
 		
@@ -331,10 +524,18 @@ class DiskWalker(object):
 		thr.start()
 		
 		print('\n\033[32mentering\033[0m', top)
-		self.dev_id = os.lstat(fsenc(top)).st_dev
-		self.walk(top)
+		sr = os.lstat(fsenc(top))
+		self.dev_id = sr.st_dev
+		meta = (sr.st_ino, mtime_ns(sr))
+		if nthreads > 1:
+			self.pwalk(top, meta, nthreads)
+		else:
+			self.walk(top, meta)
 		self.cur_top = None
 		print('\033[32mleaving\033[0m', top)
+		if self.prev:
+			print('\033[32mreused {} of {} directories\033[0m'.format(
+				self.nreused, len(self.dirs)))
 
 	def from_mdw(self, top):
 		top, mdw = top.split(':', 1)
@@ -366,8 +567,7 @@ class DiskWalker(object):
 				
 				ts = datetime.strptime(isots, '%Y-%m-%d %H:%M:%S')
 				ts = calendar.timegm(ts.timetuple())
-				sha = binascii.unhexlify(sha)
-				sha = base64.b64encode(sha).decode('ascii').rstrip('=')
+				sha = tag_hash('sha1', binascii.unhexlify(sha))
 				try:
 					folders[fdir].append(sz)
 					hashtab[fdir][fname] = (sz, ts, sha)
@@ -377,11 +577,11 @@ class DiskWalker(object):
 		
 		self.errors = []
 		self.folders = []
+		self.dirs = []
 		for fpath, fsizes in folders.items():
-			folder = Folder(fpath)
-			folder.files = fsizes
+			folder = Folder(fpath, fsizes)
 			folder.hashes = hashtab[fpath]
-			sz = sum(fsizes)
+			sz = folder.nbytes
 			
 			if sz > 1*1024*1024 \
 			and (len(fsizes) > 2 or sz >= 512*1024*1024):
@@ -421,10 +621,10 @@ class DiskWalker(object):
 
 		self.errors = []
 		self.folders = []
+		self.dirs = []
 		for fpath, fsizes in folders.items():
-			folder = Folder(fpath)
-			folder.files = fsizes
-			sz = sum(fsizes)
+			folder = Folder(fpath, fsizes)
+			sz = folder.nbytes
 			
 			if sz > 1*1024*1024 \
 			and (len(fsizes) > 2 or sz >= 512*1024*1024):
@@ -448,15 +648,46 @@ class DiskWalker(object):
 			last_top = self.cur_top
 			print('\033[36mreading\033[0m', self.cur_top)
 	
-	def walk(self, top):
-		# option: exclude directory
-		#if '/zq1/hd/bismuth' in top: return
-
-		self.cur_top = top
-		dev_id = self.dev_id
-		folder = Folder(top)
+	def scan(self, top, meta):
+		"""
+		lists a single directory; returns a Folder with the files
+		(or None if there are none) and the subdirectories to walk
+		(along with their inode and mtime)
+		"""
+		pid = PATHS.add(top)
+		try:
+			prev_meta, fld, subdirs = self.prev[pid]
+			if prev_meta == meta:
+				self.nreused += 1
+				self.dirs.append((pid, meta))
+				return fld, self.restat(subdirs)
+		except KeyError:
+			pass
+		
+		failed = []
+		
+		def oof(*msg):
+			failed.append(msg)
+			self.oof(*msg)
+		
+		# without its inode and mtime the next -r lists it again
+		# (and shows the error again) instead of reusing what's missing
 		btop = fsenc(top)
-		for bfn, sr in statdir(self.oof, btop, True):
+		try:
+			listing = list(statdir(oof, btop, True))
+		except:
+			self.dirs.append((pid, None))
+			raise
+		
+		self.dirs.append((pid, None if failed else meta))
+		
+		dev_id = self.dev_id
+		sizes = []
+		inos = []
+		nlinks = []
+		allocs = []
+		subdirs = []
+		for bfn, sr in listing:
 			bpath = os.path.join(btop, bfn)
 			if b'\n' in bpath:
 				continue
@@ -470,12 +701,7 @@ class DiskWalker(object):
 				self.oof('\033[35mskipping mountpoint:\033[0m', fsdec(bpath))
 			
 			elif stat.S_ISDIR(mode):
-				try:
-					self.walk(fsdec(bpath))
-				except KeyboardInterrupt:
-					raise
-				except:
-					self.oof('\033[1;31maccess denied:\033[0m', fsdec(bpath))
+				subdirs.append((fsdec(bpath), (sr.st_ino, mtime_ns(sr))))
 
 			elif not stat.S_ISREG(mode):
 				continue
@@ -483,232 +709,1680 @@ class DiskWalker(object):
 			if sr.st_size <= 0:
 				continue
 			
-			folder.files.append(sr.st_size)
-
-		sz = sum(folder.files)
+			try:
+				alloc = sr.st_blocks * 512
+			except AttributeError:
+				alloc = sr.st_size  # windows
+			
+			sizes.append(sr.st_size)
+			inos.append(sr.st_ino)
+			nlinks.append(sr.st_nlink)
+			allocs.append(alloc)
 		
-		if folder.files \
-		and sz > 1*1024*1024 \
-		and (len(folder.files) > 2 or sz >= 512*1024*1024):
-			self.folders.append(folder)
-
-
-def gen_dupe_map(roots, snap_path):
-	print("\nscanning disk...")
+		if not sizes:
+			return None, subdirs
+		
+		return Folder(pid, sizes, dev_id, inos, nlinks, allocs), subdirs
 	
-	t0 = time.time()
-	folders = []
-	errors = []
+	def restat(self, paths):
+		"""
+		subdirectories of an unchanged directory; these can only have been
+		renamed/deleted if the parent mtime changed, but may have turned
+		into mountpoints or been swapped for symlinks in the meantime
+		"""
+		ret = []
+		for pid in paths:
+			path = PATHS.path(pid)
+			bpath = fsenc(path)
+			try:
+				sr = os.lstat(bpath)
+			except KeyboardInterrupt:
+				raise
+			except:
+				self.oof('\033[1;31maccess denied:\033[0m', path)
+				continue
+			
+			if not stat.S_ISDIR(sr.st_mode):
+				continue
+			
+			if sr.st_dev != self.dev_id and not ANYWIN:
+				self.oof('\033[35mskipping mountpoint:\033[0m', path)
+				continue
+			
+			ret.append((path, (sr.st_ino, mtime_ns(sr))))
+		
+		return ret
 	
-	if os.path.isfile(snap_path):
-		with gzip.open(snap_path, 'rb') as f:
-			while True:
-				ln = f.readline()[:-1].decode('utf-8', ENC_FILTER)
-				if ln == 'eof':
-					break
-				
-				if not ln.startswith('p '):
-					raise Exception('p expected, got ' + ln)
-				
-				ln2 = f.readline()[:-1].decode('utf-8')
-				if not ln2.startswith('f '):
-					raise Exception('f expected, got ' + ln2)
-					
-				folder = Folder(ln[2:])
-				for sz in ln2[2:].split(' '):
-					folder.files.append(int(sz))
-				
-				folders.append(folder)
-	else:
-		for root in roots:
-			dw = DiskWalker(root)
-			folders.extend(dw.folders)
-			errors.extend(dw.errors)
+	def keep(self, fld):
+		if fld \
+		and fld.nbytes > 1*1024*1024 \
+		and (fld.nfiles > 2 or fld.nbytes >= 512*1024*1024):
+			self.folders.append(fld)
 	
-	if errors:
-		print('{} errors occurred:'.format(len(errors)))
-		for error in errors:
-			print(error)
+	def walk(self, top, meta):
+		# option: exclude directory
+		#if '/zq1/hd/bismuth' in top: return
+
+		self.cur_top = top
+		fld, subdirs = self.scan(top, meta)
+		for subdir, submeta in subdirs:
+			try:
+				self.walk(subdir, submeta)
+			except KeyboardInterrupt:
+				raise
+			except:
+				self.oof('\033[1;31maccess denied:\033[0m', subdir)
 		
-		print('these will be repeated after the dupemap generation finishes')
+		self.keep(fld)
 	
-	if not os.path.isfile(snap_path):
-		print("\ndumping snapshot to", snap_path)
-		with gzip.open(snap_path, 'wb') as f:
-			for fld in folders:
-				txt = 'p {}\nf {}\n'.format(fld.path,
-					' '.join(str(x) for x in fld.files))
+	def pwalk(self, top, meta, nthreads):
+		"""
+		same result as walk, but lists up to nthreads directories at once
+		(for network mounts where each listing is a roundtrip or more)
+		"""
+		listings = {}
+		q = Queue()
+		
+		def worker():
+			while True:
+				task = q.get()
+				if task is None:
+					return
 				
-				f.write(txt.encode('utf-8', ENC_FILTER))
-			
-			f.write(b'eof\n')
-	
-	print("generating dupemap (hope you're using pypy w)")
-
-	# compare each unique permutation of [Folder,Folder]
-	t1 = time.time()
-	nth = 0
-	dupes = []
-	remains = len(folders)
-	for folder1 in folders:
-		#print(str(folder))
-		nth += 1
-		remains -= 1
-		if nth % 10 == 0:
-			print('{} / {}'.format(nth, remains))
+				path, meta = task
+				try:
+					self.cur_top = path
+					listings[path] = fld, subdirs = self.scan(path, meta)
+					for subdir in subdirs:
+						q.put(subdir)
+				except:
+					self.oof('\033[1;31maccess denied:\033[0m', path)
+				finally:
+					q.task_done()
 		
-		mnt = folder1.path[:8]  # pylint: disable=unused-variable
+		thrs = []
+		for _ in range(nthreads):
+			thr = threading.Thread(target=worker)
+			thr.daemon = True
+			thr.start()
+			thrs.append(thr)
 		
-		sf1 = set(folder1.files)
-		for folder2 in folders[nth:]:
-
-			# option: uncomment to only compare between different drives
-			# (first 8 letters of each absolute path must be different)
-			#if folder2.path.startswith(mnt): continue
-			
-			
-			# hits = each file size that matched,
-			# there's duplicate values so plain intersect is ng
-			#
-			# was 180.8 sec
-			# now  29.7 sec
+		# the top folder itself is listed here so errors propagate like walk
+		self.cur_top = top
+		listings[top] = fld, subdirs = self.scan(top, meta)
+		for subdir in subdirs:
+			q.put(subdir)
+		
+		q.join()
+		for thr in thrs:
+			q.put(None)
+		
+		# collect the folders in the same (depth-first, post-order) sequence
+		# as walk so the dupe map comes out identical
+		stack = [(top, False)]
+		while stack:
+			path, visited = stack.pop()
+			try:
+				fld, subdirs = listings.pop(path) if visited else listings[path]
+			except KeyError:
+				continue  # access denied
 			
-			isect = sf1.intersection(folder2.files)
-			if not isect:
+			if visited:
+				self.keep(fld)
 				continue
 			
-			hits = []
-			l1 = folder1.files[:]
-			l2 = folder2.files[:]
-			for sz in isect:
-				while sz in l1 and sz in l2:
-					hits.append(sz)
-					l1.remove(sz)
-					l2.remove(sz)
-
-			score = (len(hits) * 2.0) / (
-				len(folder1.files) + len(folder2.files))
-			
-			if False:
-				print('\n{}\n{}\n  score {:.2f}, len[{},{}], sz[{},{}], hits {}'.format(
-					folder1.path, folder2.path, score,
-					len(folder1.files), len(folder2.files),
-					sum(folder1.files), sum(folder2.files), sum(hits)))
-			
-			# sufficiently large hits skip all the checks
-			if sum(hits) < 600 * 1024 * 1024:
-				
-				# must be 20% or more files with identical size
-				if score < 0.2:
-					continue
-				
-				# total disk consumption must be <= 30% different
-				a = sum(folder1.files)
-				b = sum(folder2.files)
-				if min(a,b) * 1.0 / max(a,b) < 0.7:
-					continue
+			stack.append((path, True))
+			stack.extend((x, False) for x, _ in reversed(subdirs))
+
+
+def pair_hits(fld1, fld2):
+	"""
+	number of files with identical size in both folders,
+	and the sum of those sizes
+	"""
+	# there's duplicate values so plain intersect is ng;
+	# single merge pass over the sorted sizes instead,
+	# skipping ahead with bisect on mismatch
+	l1 = fld1.files
+	l2 = fld2.files
+	n1 = fld1.nfiles
+	n2 = fld2.nfiles
+	i1 = i2 = 0
+	nhits = 0
+	hit_sz = 0
+	while i1 < n1 and i2 < n2:
+		sz1 = l1[i1]
+		sz2 = l2[i2]
+		if sz1 < sz2:
+			i1 = bisect.bisect_left(l1, sz2, i1 + 1, n1)
+		elif sz1 > sz2:
+			i2 = bisect.bisect_left(l2, sz1, i2 + 1, n2)
+		else:
+			nhits += 1
+			hit_sz += sz1
+			i1 += 1
+			i2 += 1
+	
+	return nhits, hit_sz
+
+
+def pair_reclaim(fld1, fld2):
+	"""
+	bytes freed by deleting the folder of the two which frees more;
+	like pair_hits but files hardlinked to each other (or to anything
+	else) free nothing, and sparse files only their allocated blocks
+	"""
+	if not fld1.inos or not fld2.inos:
+		return pair_hits(fld1, fld2)[1]
+	
+	l1 = fld1.files
+	l2 = fld2.files
+	n1 = fld1.nfiles
+	n2 = fld2.nfiles
+	same_dev = fld1.dev == fld2.dev
+	i1 = i2 = 0
+	free1 = free2 = 0
+	while i1 < n1 and i2 < n2:
+		sz1 = l1[i1]
+		sz2 = l2[i2]
+		if sz1 < sz2:
+			i1 = bisect.bisect_left(l1, sz2, i1 + 1, n1)
+		elif sz1 > sz2:
+			i2 = bisect.bisect_left(l2, sz1, i2 + 1, n2)
+		else:
+			if not same_dev or fld1.inos[i1] != fld2.inos[i2]:
+				if fld1.nlinks[i1] == 1:
+					free1 += fld1.allocs[i1]
 				
-				# matched files must amount to >= 20% of bytes
-				if sum(hits) < a * 0.2 \
-				and sum(hits) < b * 0.2:
-					continue
+				if fld2.nlinks[i2] == 1:
+					free2 += fld2.allocs[i2]
 			
-			dupes.append((score, folder1, folder2))
+			i1 += 1
+			i2 += 1
+	
+	return max(free1, free2)
 
-	t2 = time.time()
+
+# hits this large are dupes regardless of the other rules
+BIG_HIT = 600 * 1024 * 1024
+
+
+def dupe_score(nhits, hit_sz, fld1, fld2):
+	"""returns the score of a folder pair, or None if it's not a dupe"""
+	score = (nhits * 2.0) / (fld1.nfiles + fld2.nfiles)
 	
-	if errors:
-		print('\nok so about those errors from before,')
-		for error in errors:
-			print(error)
-		
-		print('\nare these {} errors ok? press ENTER to continue or CTRL-C'.format(len(errors)))
-		input()
+	# sufficiently large hits skip all the checks
+	if hit_sz >= BIG_HIT:
+		return score
 	
-	return dupes, (t1-t0, t2-t1)
+	# must be 20% or more files with identical size
+	if score < 0.2:
+		return None
+	
+	# total disk consumption must be <= 30% different
+	a = fld1.nbytes
+	b = fld2.nbytes
+	if min(a,b) * 1.0 / max(a,b) < 0.7:
+		return None
+	
+	# matched files must amount to >= 20% of bytes
+	if hit_sz < a * 0.2 \
+	and hit_sz < b * 0.2:
+		return None
+	
+	return score
 
 
-def save_dupe_map(cache_path, dupes):
-	with gzip.open(cache_path, 'wb') as f:
-		seen_folders = {}
-		n = 0
+def content_index(fld):
+	"""
+	(number of files of each size, {size: {algo: files hashed with it}},
+	{hash: [size, count]}) of a folder, for pair_hits_hashed;
+	if the folder has more hashes of some size than files of that
+	size then some are stale, so that size is left unhashed
+	"""
+	nsize = {}
+	for sz in fld.files:
+		nsize[sz] = nsize.get(sz, 0) + 1
+	
+	by_size = {}
+	for sz, _, sha in fld.hashes.values():
+		if sz in nsize and sha not in ['x', '~']:
+			try:
+				by_size[sz].append(sha)
+			except:
+				by_size[sz] = [sha]
+	
+	algos = {}
+	hashed = {}
+	for sz, shas in by_size.items():
+		if len(shas) > nsize[sz]:
+			continue
 		
-		# serialize folders that contain dupes
-		for _, fld1, fld2 in dupes:
-			for fld in (fld1, fld2):
-				if fld not in seen_folders:
-					txt = 'p {}\nf {}\n'.format(fld.path,
-						' '.join(str(x) for x in fld.files))
-					
-					f.write(txt.encode('utf-8', ENC_FILTER))
-					seen_folders[fld] = n
-					n += 1
+		nalgo = algos[sz] = {}
+		for sha in shas:
+			algo = hash_algo(sha)
+			nalgo[algo] = nalgo.get(algo, 0) + 1
+			try:
+				hashed[sha][1] += 1
+			except:
+				hashed[sha] = [sz, 1]
+	
+	return nsize, algos, hashed
+
+
+def pair_hits_hashed(idx1, idx2):
+	"""
+	like pair_hits (given two content_index), but files which are hashed
+	with the same algorithm in both folders only count if the hashes are
+	the same; files without a hash (or hashed with another algorithm,
+	like sha1 from an mdw and blake2b from --hash) still match by size
+	"""
+	nsize1, algos1, hashed1 = idx1
+	nsize2, algos2, hashed2 = idx2
+	same = {}
+	for sha, (sz, cnt) in hashed1.items():
+		other = hashed2.get(sha)
+		if other:
+			nsame = same.setdefault(sz, {})
+			algo = hash_algo(sha)
+			nsame[algo] = nsame.get(algo, 0) + min(cnt, other[1])
+	
+	nhits = 0
+	hit_sz = 0
+	for sz, n1 in nsize1.items():
+		n2 = nsize2.get(sz)
+		if not n2:
+			continue
 		
-		# serialize dupe info
-		for score, fld1, fld2 in dupes:
-			f.write('d {} {} {}\n'.format(
-				int(score*1000),
-				seen_folders[fld1],
-				seen_folders[fld2]).encode('utf-8'))
+		# for each algorithm used on both sides, the files of the others
+		# pair up by size same as unhashed files; the fewest hits wins
+		k = min(n1, n2)
+		nsame = same.get(sz, {})
+		nalgo2 = algos2.get(sz, {})
+		for algo, cnt1 in algos1.get(sz, {}).items():
+			if algo in nalgo2:
+				ka = nsame.get(algo, 0)
+				ka += min(n1 - ka, n2 - ka, n1 - cnt1 + n2 - nalgo2[algo])
+				k = min(k, ka)
 		
-		f.write(b'eof\n')
+		nhits += k
+		hit_sz += k * sz
+	
+	return nhits, hit_sz
 
 
-def load_dupe_map(cache_path):
-	folders = []
-	dupes = []
-	with gzip.open(cache_path, 'rb') as f:
-		while True:
-			ln = f.readline()[:-1].decode('utf-8', ENC_FILTER)
-			if ln.startswith('p '):
-				ln2 = f.readline()[:-1].decode('utf-8')
-				if not ln2.startswith('f '):
-					raise Exception('non-f after p')
-				
-				folder = Folder(ln[2:])
-				for sz in ln2[2:].split(' '):
-					folder.files.append(int(sz))
-				
-				folders.append(folder)
-				continue
+def match_hashed(folders, matches):
+	"""
+	second pass over the size matches [(score, n1, n2), ...] which
+	rescores pairs where both folders have file hashes (from an mdw,
+	or the hashdb) with pair_hits_hashed. That can only lower the number
+	of hits, so any pair it would accept is among the size matches already
+	"""
+	idx = {}
+	ret = []
+	nrescored = 0
+	for score, n1, n2 in matches:
+		fld1 = folders[n1]
+		fld2 = folders[n2]
+		if fld1.has_hashes() and fld2.has_hashes():
+			for n in [n1, n2]:
+				if n not in idx:
+					idx[n] = content_index(folders[n])
 			
-			if ln.startswith('d '):
-				score, i1, i2 = [int(x) for x in ln[2:].split(' ')]
-				dupes.append((score/1000., folders[i1], folders[i2]))
+			nhits, hit_sz = pair_hits_hashed(idx[n1], idx[n2])
+			score = dupe_score(nhits, hit_sz, fld1, fld2)
+			nrescored += 1
+			if score is None:
 				continue
-			
-			if ln == 'eof':
-				break
-			
-			raise Exception('unexpected line: {}'.format(ln))
-
-	return dupes
-
-
-def colorize_score(score):
-	if score == "xxx":
-		return '0;37', score
+		
+		ret.append((score, n1, n2))
 	
-	if score < 0.2:
-		c = '1;30'
-	elif score < 0.35:
-		c = '0;31'
-	elif score < 0.5:
-		c = '0;36'
-	elif score < 0.7:
-		c = '0;33'
-	elif score < 0.9:
-		c = '1;32'
-	elif score <= 1:
-		c = '1;37;44;48;5;28'
-	else:
-		c = '1;37;41'
+	print('matched {} pairs by hash, {} of those were not dupes after all'.format(
+		nrescored, len(matches) - len(ret)))
 	
-	return c, int(score*100)
+	return ret
 
 
-def dump_summary(dupes):
-	# keep track of the 1st folder in the pair,
+def stop_sizes(folders, max_df=0, min_sz=0):
+	"""
+	file sizes which are too common (found in more than max_df folders)
+	or too small (below min_sz bytes) to be worth looking for candidate
+	pairs with; they still count toward the score of pairs found through
+	other sizes. Prints how much each rule removed; the number of pairs
+	is an upper bound, since counting the pairs which had nothing else in
+	common would take the same all-pairs work that these rules avoid
+	"""
+	if not max_df and not min_sz:
+		return set()
+	
+	df = {}
+	for fld in folders:
+		for sz in set(fld.files):
+			df[sz] = df.get(sz, 0) + 1
+	
+	stopped = {}
+	stats = {}
+	for sz, n in df.items():
+		if sz < min_sz:
+			rule = '--stop-min'
+		elif max_df and n > max_df:
+			rule = '--stop-df'
+		else:
+			continue
+		
+		stopped[sz] = rule
+		st = stats.setdefault(rule, [0, 0, 0])
+		st[0] += 1
+		st[2] += n * (n - 1) // 2
+	
+	for fld in folders:
+		for rule in set(stopped.get(sz) for sz in fld.files):
+			if rule:
+				stats[rule][1] += 1
+	
+	for rule in ['--stop-min', '--stop-df']:
+		if rule in stats:
+			nsizes, nfound, nshared = stats[rule]
+			nshared = min(nshared, nfound * (nfound - 1) // 2)
+			print('{}: left out {} sizes found in {} folders; at most {} folder pairs (those sharing one) are no longer compared'.format(
+				rule, nsizes, nfound, nshared))
+	
+	return set(stopped)
+
+
+class PairsMatcher(object):
+	"""
+	reference engine; compares each unique permutation of [Folder,Folder]
+	(only those from different sources if cross)
+	"""
+	def __init__(self, folders, stop=(), cross=False):
+		self.folders = folders
+		self.stop = stop
+		self.cross = cross
+	
+	def match(self, lo, hi, verbose=True):
+		"""returns [(score, n1, n2), ...] for each folder n1 in lo..hi"""
+		ret = []
+		folders = self.folders
+		nfolders = len(folders)
+		for n1 in range(lo, hi):
+			folder1 = folders[n1]
+			if verbose and n1 % 10 == 0:
+				print('{} / {}'.format(n1, nfolders - n1))
+			
+			sf1 = set(folder1.files)
+			sf1.difference_update(self.stop)
+			for n2 in range(n1 + 1, nfolders):
+				folder2 = folders[n2]
+				if self.cross and folder2.src == folder1.src:
+					continue
+				
+				if sf1.isdisjoint(folder2.files):
+					continue
+				
+				nhits, hit_sz = pair_hits(folder1, folder2)
+				score = dupe_score(nhits, hit_sz, folder1, folder2)
+				if score is not None:
+					ret.append((score, n1, n2))
+		
+		return ret
+
+
+def size_index(folders, ids=None):
+	"""
+	posting lists of folder indexes (ascending) for each file size;
+	ids replaces the indexes if given
+	"""
+	ret = {}
+	for n, fld in zip(ids or itertools.count(), folders):
+		for sz in set(fld.files):
+			try:
+				ret[sz].append(n)
+			except:
+				ret[sz] = [n]
+	
+	return ret
+
+
+class IndexMatcher(object):
+	"""
+	only compares folders which have at least one file size in common,
+	by collecting the candidates from the size index; the postings are
+	ordered by folder total size, so each folder only takes the window
+	of folders within the 30% rule from them (plus, if it's big enough,
+	the folders big enough for a BIG_HIT). If cross, there is one index
+	per source, and each folder only looks in the indexes of the others
+	"""
+	def __init__(self, folders, stop=(), cross=False):
+		self.folders = folders
+		self.by_size = sorted(range(len(folders)),
+			key=lambda n: folders[n].nbytes)
+		
+		self.sorted_nbytes = [folders[n].nbytes for n in self.by_size]
+		
+		# [(source or None, postings, highest folder index within)]
+		self.indexes = []
+		if cross:
+			ranks = {}
+			for r, n in enumerate(self.by_size):
+				ranks.setdefault(folders[n].src, []).append(r)
+			
+			for src, rs in sorted(ranks.items()):
+				self.indexes.append((src, size_index(
+					[folders[self.by_size[r]] for r in rs], rs),
+					max(self.by_size[r] for r in rs)))
+		else:
+			self.indexes.append((None, size_index(
+				[folders[n] for n in self.by_size]), len(folders)))
+		
+		for _, postings, _ in self.indexes:
+			for sz in stop:
+				postings.pop(sz, None)
+	
+	def match(self, lo, hi, verbose=True):
+		ret = []
+		folders = self.folders
+		nfolders = len(folders)
+		by_size = self.by_size
+		sorted_nbytes = self.sorted_nbytes
+		big = bisect.bisect_left(sorted_nbytes, BIG_HIT)
+		for n1 in range(lo, hi):
+			folder1 = folders[n1]
+			if verbose and n1 % 1000 == 0:
+				print('{} / {}'.format(n1, nfolders - n1))
+			
+			# slightly wider than the 30% rule; dupe_score has the final say
+			nbytes = folder1.nbytes
+			windows = [(
+				bisect.bisect_left(sorted_nbytes, int(nbytes * 0.6999)),
+				bisect.bisect_right(sorted_nbytes, int(nbytes / 0.6999) + 1))]
+			
+			if nbytes >= BIG_HIT:
+				r0, r1 = windows[0]
+				windows.append((big, max(big, r0)))
+				windows.append((max(big, r1), nfolders))
+			
+			# skipping sources which are all before this folder
+			indexes = [postings for src, postings, last in self.indexes
+				if last > n1 and src != folder1.src]
+			
+			cands = set()
+			for sz in set(folder1.files):
+				for postings in indexes:
+					posting = postings.get(sz)
+					if not posting:
+						continue
+					
+					for r0, r1 in windows:
+						cands.update(posting[
+							bisect.bisect_left(posting, r0) :
+							bisect.bisect_left(posting, r1)])
+			
+			cands = [by_size[r] for r in cands]
+			for n2 in sorted(n2 for n2 in cands if n2 > n1):
+				folder2 = folders[n2]
+				nhits, hit_sz = pair_hits(folder1, folder2)
+				score = dupe_score(nhits, hit_sz, folder1, folder2)
+				if score is not None:
+					ret.append((score, n1, n2))
+		
+		return ret
+
+
+class NumpyMatcher(object):
+	"""
+	vectorized engine; the sizes of all folders in one sorted uint64 array,
+	candidate pairs from the size postings are counted and scored in batches;
+	stop sizes are left out of the postings and looked up separately,
+	and with cross the pairs from the same source are dropped on expansion
+	"""
+	# max candidate expansions per numpy call
+	BATCH = 1 << 21
+
+	def __init__(self, folders, stop=(), cross=False):
+		self.folders = folders
+		self.cross = cross
+		nfolders = len(folders)
+		self.src = np.fromiter(
+			(f.src for f in folders), np.int64, nfolders)
+		
+		self.nfiles = np.fromiter(
+			(f.nfiles for f in folders), np.int64, nfolders)
+		
+		self.nbytes = np.fromiter(
+			(f.nbytes for f in folders), np.int64, nfolders)
+		
+		self.offsets = np.zeros(nfolders + 1, np.int64)
+		np.cumsum(self.nfiles, out=self.offsets[1:])
+		
+		nsizes = int(self.offsets[-1])
+		sizes = np.zeros(nsizes, np.uint64)
+		for f, ofs in zip(folders, self.offsets.tolist()):
+			if f.nfiles:
+				sizes[ofs : ofs + f.nfiles] = f.files if U64 == 'd' \
+					else np.frombuffer(f.files, np.uint64)
+		
+		self.sizes = sizes
+		
+		# collapse identical sizes within a folder into runs
+		fid = np.repeat(np.arange(nfolders), self.nfiles)
+		new = np.ones(nsizes, bool)
+		new[1:] = (fid[1:] != fid[:-1]) | (sizes[1:] != sizes[:-1])
+		starts = np.flatnonzero(new)
+		self.run_fid = fid[starts]
+		self.run_sz = sizes[starts]
+		self.run_cnt = np.diff(np.append(starts, nsizes))
+		self.run_off = np.searchsorted(self.run_fid, np.arange(nfolders + 1))
+		
+		# size postings; all runs ordered by size, then by folder,
+		# so the later folders sharing a size follow each run directly
+		nruns = len(self.run_sz)
+		is_stop = np.zeros(nruns, bool)
+		if stop:
+			is_stop = np.isin(self.run_sz, np.array(sorted(stop), np.uint64))
+		
+		live = np.flatnonzero(~is_stop)
+		order = live[np.lexsort((self.run_fid[live], self.run_sz[live]))]
+		self.post_fid = self.run_fid[order]
+		self.post_cnt = self.run_cnt[order]
+		psz = self.run_sz[order]
+		ends = np.append(np.flatnonzero(psz[1:] != psz[:-1]) + 1, len(psz))
+		grp_end = np.repeat(ends, np.diff(np.append(0, ends)))
+		
+		# stop runs have no partners, so expand never gets to them
+		self.run_pos = np.zeros(nruns, np.int64)
+		self.run_pos[order] = np.arange(len(order))
+		self.run_partners = np.zeros(nruns, np.int64)
+		self.run_partners[order] = grp_end - np.arange(len(order)) - 1
+		
+		# stop runs by (folder, size), as folder * nstop + dense size id
+		sruns = np.flatnonzero(is_stop)
+		self.stop_sz = np.unique(self.run_sz[sruns])
+		self.stop_sid = np.searchsorted(self.stop_sz, self.run_sz[sruns])
+		self.stop_key = self.run_fid[sruns] * len(self.stop_sz) + self.stop_sid
+		self.stop_cnt = self.run_cnt[sruns]
+		self.stop_off = np.searchsorted(self.run_fid[sruns], np.arange(nfolders + 1))
+		
+		# cumulative candidate expansions per folder, for batching
+		cum = np.append(0, np.cumsum(self.run_partners))
+		self.fld_cum = np.append(0, np.cumsum(
+			cum[self.run_off[1:]] - cum[self.run_off[:-1]]))
+	
+	def expand(self, lo, hi):
+		"""
+		unique candidate pairs (n1 in lo..hi, n2 > n1), sorted,
+		with their hit count and hit bytes; every shared size of a pair
+		turns up once in the postings with both run-lengths at hand
+		"""
+		r0 = self.run_off[lo]
+		r1 = self.run_off[hi]
+		cnt = self.run_partners[r0:r1]
+		total = int(cnt.sum())
+		
+		lrun = np.repeat(np.arange(r0, r1), cnt)
+		step = np.arange(total) - np.repeat(np.cumsum(cnt) - cnt, cnt)
+		rpos = np.repeat(self.run_pos[r0:r1] + 1, cnt) + step
+		
+		# drop what can't pass the 30% rule nor be a BIG_HIT before
+		# gathering pairs, same as the sliding window of IndexMatcher
+		fid1 = self.run_fid[lrun]
+		fid2 = self.post_fid[rpos]
+		a = self.nbytes[fid1]
+		b = self.nbytes[fid2]
+		ok = (np.minimum(a, b) * 1.0 / np.maximum(a, b) >= 0.7) \
+			| ((a >= BIG_HIT) & (b >= BIG_HIT))
+		
+		if self.cross:
+			ok &= self.src[fid1] != self.src[fid2]
+		
+		lrun = lrun[ok]
+		rpos = rpos[ok]
+		
+		hcnt = np.minimum(self.run_cnt[lrun], self.post_cnt[rpos])
+		hsz = hcnt * self.run_sz[lrun].astype(np.int64)
+		
+		nfolders = len(self.folders)
+		keys, inv = np.unique(
+			self.run_fid[lrun] * nfolders + self.post_fid[rpos],
+			return_inverse=True)
+		
+		# float sums of ints are exact below 2**53 (8 PiB) so this is fine
+		nhits = np.bincount(inv, hcnt, len(keys)).astype(np.int64)
+		hit_sz = np.bincount(inv, hsz, len(keys)).astype(np.int64)
+		return keys // nfolders, keys % nfolders, nhits, hit_sz
+	
+	def stop_hits(self, n1, n2):
+		"""
+		hit count and bytes of the stop sizes for any pairs (n1, n2);
+		each stop run of n1 is looked up among the stop runs of n2
+		"""
+		npairs = len(n1)
+		nhits = np.zeros(npairs, np.int64)
+		hit_sz = np.zeros(npairs, np.int64)
+		if not len(self.stop_key):
+			return nhits, hit_sz
+		
+		nstop = len(self.stop_sz)
+		cnt = self.stop_off[n1 + 1] - self.stop_off[n1]
+		cum = np.cumsum(cnt)
+		lo = 0
+		while lo < npairs:
+			# keep the expansion within BATCH, like match does
+			base = cum[lo] - cnt[lo]
+			hi = int(np.searchsorted(cum, base + self.BATCH, 'right'))
+			hi = min(max(hi, lo + 1), npairs)
+			c = cnt[lo:hi]
+			total = int(c.sum())
+			pair = np.repeat(np.arange(lo, hi), c)
+			step = np.arange(total) - np.repeat(np.cumsum(c) - c, c)
+			srun = np.repeat(self.stop_off[n1[lo:hi]], c) + step
+			
+			key2 = n2[pair] * nstop + self.stop_sid[srun]
+			pos = np.searchsorted(self.stop_key, key2)
+			pos = np.minimum(pos, len(self.stop_key) - 1)
+			hcnt = np.where(self.stop_key[pos] == key2,
+				np.minimum(self.stop_cnt[srun], self.stop_cnt[pos]), 0)
+			
+			hsz = hcnt * self.stop_sz[self.stop_sid[srun]].astype(np.int64)
+			nhits[lo:hi] = np.bincount(pair - lo, hcnt, hi - lo)
+			hit_sz[lo:hi] = np.bincount(pair - lo, hsz, hi - lo)
+			lo = hi
+		
+		return nhits, hit_sz
+	
+	def filter(self, n1, n2, nhits, hit_sz):
+		"""same rules as dupe_score, returns a mask and the scores"""
+		score = (nhits * 2.0) / (self.nfiles[n1] + self.nfiles[n2])
+		a = self.nbytes[n1]
+		b = self.nbytes[n2]
+		ok = (score >= 0.2) \
+			& (np.minimum(a, b) * 1.0 / np.maximum(a, b) >= 0.7) \
+			& ~((hit_sz < a * 0.2) & (hit_sz < b * 0.2))
+		
+		ok |= hit_sz >= BIG_HIT
+		return ok, score
+	
+	def match(self, lo, hi, verbose=True):
+		ret = []
+		nfolders = len(self.folders)
+		fld_cum = self.fld_cum
+		while lo < hi:
+			end = np.searchsorted(fld_cum, fld_cum[lo] + self.BATCH, 'right') - 1
+			end = min(max(int(end), lo + 1), hi)
+			if verbose:
+				print('{} / {}'.format(lo, nfolders - lo))
+			
+			n1, n2, nhits, hit_sz = self.expand(lo, end)
+			lo = end
+			
+			stop_nhits, stop_sz = self.stop_hits(n1, n2)
+			nhits += stop_nhits
+			hit_sz += stop_sz
+			
+			ok, score = self.filter(n1, n2, nhits, hit_sz)
+			ret.extend(zip(
+				score[ok].tolist(), n1[ok].tolist(), n2[ok].tolist()))
+		
+		return ret
+
+
+MATCH_ENGINES = {
+	'pairs': PairsMatcher,
+	'index': IndexMatcher,
+}
+
+if np:
+	MATCH_ENGINES['numpy'] = NumpyMatcher
+
+DEFAULT_ENGINE = 'numpy' if np else 'index'
+
+
+# the matcher which pool workers run against; inherited through fork
+# where possible, otherwise handed to each worker once by _mp_init
+_MP_MATCHER = None
+
+
+def _mp_init(matcher):
+	global _MP_MATCHER
+	_MP_MATCHER = matcher
+
+
+def _mp_match(span):
+	return _MP_MATCHER.match(span[0], span[1], False)
+
+
+def _match_mp(matcher, jobs):
+	global _MP_MATCHER
+	import multiprocessing
+
+	# the first folders have the most candidates (everything after them),
+	# so hand out lots of small spans to keep the workers evenly loaded
+	nfolders = len(matcher.folders)
+	step = max(1, nfolders // (jobs * 32))
+	spans = [(n, min(n + step, nfolders)) for n in range(0, nfolders, step)]
+	
+	try:
+		ctx = multiprocessing.get_context('fork')
+		_MP_MATCHER = matcher
+		pool = ctx.Pool(jobs)
+	except (AttributeError, ValueError):
+		# py2 (forks anyways) or windows (has to pickle it once per worker)
+		pool = multiprocessing.Pool(jobs, _mp_init, (matcher,))
+	
+	ret = []
+	try:
+		# imap keeps the span order so the result is identical to jobs=1
+		for (lo, hi), matches in zip(spans, pool.imap(_mp_match, spans)):
+			ret.extend(matches)
+			print('{} / {}'.format(hi, nfolders - hi))
+	finally:
+		pool.terminate()
+		pool.join()
+		_MP_MATCHER = None
+	
+	return ret
+
+
+def exact_groups(folders, cross=False):
+	"""
+	groups folders which have exactly the same file sizes, by a hash
+	of the sorted sizes; returns the index of the first folder of each
+	group (ascending) and {first: [the others]} for groups of two or more.
+	If cross, each group only has folders from one source
+	"""
+	seen = {}
+	firsts = []
+	copies = {}
+	for n, fld in enumerate(folders):
+		key = (fld.nfiles, fld.nbytes, hash(tuple(fld.files)))
+		if cross:
+			key += (fld.src,)
+		
+		for first in seen.get(key, ()):
+			if folders[first].files == fld.files:
+				copies.setdefault(first, []).append(n)
+				break
+		else:
+			seen.setdefault(key, []).append(n)
+			firsts.append(n)
+	
+	return firsts, copies
+
+
+def expand_groups(folders, firsts, copies, matches, cross=False):
+	"""
+	turns matches between the firsts of each group into matches between
+	all their folders, plus every pair within a group (unless cross),
+	in the same order as matching all the folders would have given
+	(the scores are the same since the sizes are)
+	"""
+	ret = []
+	for score, i1, i2 in matches:
+		n1 = firsts[i1]
+		n2 = firsts[i2]
+		for m1 in [n1] + copies.get(n1, []):
+			for m2 in [n2] + copies.get(n2, []):
+				ret.append((score, min(m1, m2), max(m1, m2)))
+	
+	for first, others in copies.items():
+		fld = folders[first]
+		score = dupe_score(fld.nfiles, fld.nbytes, fld, fld)
+		if score is None or cross:
+			continue
+		
+		group = [first] + others
+		for i, m1 in enumerate(group):
+			for m2 in group[i + 1:]:
+				ret.append((score, m1, m2))
+	
+	ret.sort(key=lambda x: (x[1], x[2]))
+	return ret
+
+
+def match_folders(folders, engine=DEFAULT_ENGINE, jobs=1,
+	stop_df=0, stop_min=0, cross=False):
+	"""
+	returns [(score, Folder, Folder), ...] ordered by position in folders;
+	all engines must produce identical results, the reference being "pairs".
+	Folders with hashes are then compared by content where possible,
+	stop_df/stop_min are passed to stop_sizes, and if cross only
+	folders from different sources (Folder.src) are paired
+	"""
+	if cross:
+		nsrc = len(set(fld.src for fld in folders))
+		print('only matching between sources; {} of them'.format(nsrc))
+		if nsrc < 2:
+			print('\033[33m--cross needs two or more folders to scan (or a snapshot from before this option: -u to rescan)\033[0m')
+	
+	# exact copies (by size) are matched just once, as the first of each
+	firsts, copies = exact_groups(folders, cross)
+	subset = folders
+	if copies:
+		subset = [folders[n] for n in firsts]
+		print('{} folders are exact copies (by size) of {} others'.format(
+			len(folders) - len(firsts), len(copies)))
+	
+	stop = stop_sizes(subset, stop_df, stop_min)
+	matcher = MATCH_ENGINES[engine](subset, stop, cross)
+	if jobs > 1 and len(subset) > 1:
+		matches = _match_mp(matcher, jobs)
+	else:
+		matches = matcher.match(0, len(subset))
+	
+	if copies:
+		matches = expand_groups(folders, firsts, copies, matches, cross)
+	
+	if any(fld.has_hashes() for fld in folders):
+		matches = match_hashed(folders, matches)
+	
+	return [(score, folders[n1], folders[n2]) for score, n1, n2 in matches]
+
+
+def bench_folders(nfolders, seed=1):
+	"""
+	synthetic folders for --bench-match; albums, copies of them which
+	lost or gained a file or two, and some thumbnail-sized files in common
+	"""
+	import random
+	
+	rnd = random.Random(seed)
+	rndsize = lambda: int(2 ** rnd.uniform(16, 32))
+	common = [rnd.randint(1024, 65536) for _ in range(20)]
+	albums = []
+	ret = []
+	for n in range(nfolders):
+		if albums and rnd.random() < 0.6:
+			files = list(rnd.choice(albums))
+			for _ in range(rnd.randint(0, 2)):
+				if files and rnd.random() < 0.5:
+					files.pop(rnd.randrange(len(files)))
+				else:
+					files.append(rndsize())
+		else:
+			files = [rndsize() for _ in range(rnd.randint(3, 30))]
+			albums.append(files)
+		
+		if rnd.random() < 0.3:
+			files.append(rnd.choice(common))
+		
+		ret.append(Folder('/smf-bench/{}'.format(n), files, src=n % 2))
+	
+	return ret
+
+
+def bench_match(nfolders, jobs=1, stop_df=0, stop_min=0, cross=False):
+	"""time each matcher on the same synthetic folders, and compare results"""
+	folders = bench_folders(nfolders)
+	print('{} synthetic folders, {} files'.format(
+		nfolders, sum(fld.nfiles for fld in folders)))
+	
+	times = []
+	ref = None
+	for engine in sorted(MATCH_ENGINES):
+		if engine == 'pairs' and nfolders > 5000:
+			times.append((engine, None, 'skipped; too slow for this many folders'))
+			continue
+		
+		print('\n\033[36m{}:\033[0m'.format(engine))
+		t0 = time.time()
+		matches = match_folders(folders, engine, jobs, stop_df, stop_min, cross)
+		secs = time.time() - t0
+		
+		res = [(score, fld1.pid, fld2.pid) for score, fld1, fld2 in matches]
+		if ref is None:
+			ref = res
+		
+		note = '{} pairs'.format(len(res))
+		if res != ref:
+			note += ', \033[31mdifferent from {}\033[0m'.format(times[0][0])
+		
+		times.append((engine, secs, note))
+	
+	print()
+	for engine, secs, note in times:
+		if secs is None:
+			print('{:8} {}'.format(engine, note))
+		else:
+			print('{:8} {:8.2f} sec, {:9.0f} folders/s, {}'.format(
+				engine, secs, nfolders / max(secs, 0.001), note))
+
+
+# binary snapshot/cache format; a header and a table of sections, each
+# section being a little-endian array, 8-byte aligned so it can be used
+# straight out of an mmap:
+#
+#   "SMFB" u32:version 4s:kind u32:nsections
+#   nsections * [8s:name 4s:typecode u64:count u64:offset]
+#
+# the typecodes are B, I, q and Q (same as struct), whatever the
+# arrays in memory are (see I64/U64)
+
+BIN_MAGIC = b'SMFB'
+BIN_VERSION = 1
+
+# typecode in the file of each typecode in memory, and back
+BIN_TC = {'B': 'B', 'I': 'I', I64: 'q', U64: 'Q'}
+if U64 == 'd':
+	BIN_TC['d'] = 'q'  # may be either; the values fit both
+
+ARRAY_TC = {'B': 'B', 'I': 'I', 'q': I64, 'Q': U64}
+
+
+def is_binfile(path):
+	with open(path, 'rb') as f:
+		return f.read(4) == BIN_MAGIC
+
+
+def _align8(n):
+	return (n + 7) & ~7
+
+
+def _bin_bytes(arr):
+	"""the contents of an array as it goes in the file"""
+	tc = BIN_TC[arr.typecode]
+	if arr.typecode == 'd':
+		return struct.pack('<{}{}'.format(len(arr), tc), *[int(x) for x in arr])
+	
+	if sys.byteorder != 'little':
+		arr = array.array(arr.typecode, arr)
+		arr.byteswap()
+	
+	return arr.tostring() if PY2 else arr.tobytes()
+
+
+def bin_save(path, kind, sections):
+	"""sections is a list of (name, array.array)"""
+	ofs = _align8(16 + 28 * len(sections))
+	table = []
+	for name, arr in sections:
+		tc = BIN_TC[arr.typecode]
+		table.append(struct.pack('<8s4sQQ', name,
+			tc.encode('ascii'), len(arr), ofs))
+		
+		ofs = _align8(ofs + len(arr) * struct.calcsize(tc))
+	
+	# write to a tempfile and rename it into place,
+	# since the previous one may still be mmap'ed by a LazyDupes
+	tmp_path = path + '.tmp'
+	with open(tmp_path, 'wb') as f:
+		f.write(struct.pack('<4sI4sI', BIN_MAGIC, BIN_VERSION, kind, len(sections)))
+		f.write(b''.join(table))
+		for _, arr in sections:
+			f.write(b'\0' * (_align8(f.tell()) - f.tell()))
+			f.write(_bin_bytes(arr))
+	
+	if PY2 or ANYWIN:
+		try:
+			os.remove(path)
+		except:
+			pass
+		
+		os.rename(tmp_path, path)
+	else:
+		os.replace(tmp_path, path)
+
+
+class BinFile(object):
+	"""read-only mmap of a bin_save file"""
+	def __init__(self, path, kind):
+		with open(path, 'rb') as f:
+			if ANYWIN:
+				# mapped files can't be replaced or deleted on windows
+				self.mm = f.read()
+			else:
+				self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		
+		magic, ver, fkind, nsect = struct.unpack_from('<4sI4sI', self.mm, 0)
+		if magic != BIN_MAGIC or fkind != kind:
+			raise Exception('{} is not a {} file'.format(path, kind))
+		
+		if ver != BIN_VERSION:
+			raise Exception('{} is format version {}, expected {}'.format(
+				path, ver, BIN_VERSION))
+		
+		self.sections = {}
+		for n in range(nsect):
+			name, tc, count, ofs = struct.unpack_from(
+				'<8s4sQQ', self.mm, 16 + 28 * n)
+			
+			self.sections[name.rstrip(b'\0')] = (
+				tc.rstrip(b'\0').decode('ascii'), count, ofs)
+	
+	def get(self, name):
+		"""
+		a memoryview (zero-copy) of a section, or a copy as an array
+		(bytes if B) on big-endian or py2 (can't memoryview an mmap);
+		a list if the array would be doubles, since these are indexes too
+		"""
+		tc, count, ofs = self.sections[name]
+		end = ofs + count * struct.calcsize(tc)
+		if not PY2 and sys.byteorder == 'little':
+			raw = memoryview(self.mm)[ofs:end]
+			return raw.cast(tc) if tc != 'B' else raw
+		
+		raw = self.mm[ofs:end]
+		atc = ARRAY_TC[tc]
+		if tc == 'B':
+			return raw
+		
+		if atc == 'd':
+			return list(struct.unpack('<{}{}'.format(count, tc), raw))
+		
+		ret = array.array(atc)
+		if PY2:
+			ret.fromstring(raw)
+		else:
+			ret.frombytes(raw)
+		
+		if sys.byteorder != 'little':
+			ret.byteswap()
+		
+		return ret
+
+
+def _bin_strings(strs):
+	"""string table and offsets table"""
+	strtab = array.array('B')
+	stroff = array.array(U64, [0])
+	for s in strs:
+		strtab.extend(bytearray(s.encode('utf-8', ENC_FILTER)))
+		stroff.append(len(strtab))
+	
+	return [(b'strtab', strtab), (b'stroff', stroff)]
+
+
+def _bin_folders(folders):
+	sizes = array.array(U64)
+	for fld in folders:
+		sizes.extend(fld.files)
+	
+	sizeoff = array.array(U64, [0])
+	for fld in folders:
+		sizeoff.append(sizeoff[-1] + fld.nfiles)
+	
+	# folders without link info (mdw/rfl) get nlink 0
+	links = [array.array(U64), array.array('I'), array.array(U64)]
+	for fld in folders:
+		if fld.inos:
+			links[0].extend(fld.inos)
+			links[1].extend(fld.nlinks)
+			links[2].extend(fld.allocs)
+		else:
+			for arr in links:
+				arr.extend([0] * fld.nfiles)
+	
+	return [(b'sizeoff', sizeoff), (b'sizes', sizes),
+		(b'flddev', array.array(U64, [fld.dev for fld in folders])),
+		(b'inos', links[0]), (b'nlinks', links[1]), (b'allocs', links[2])]
+
+
+def _bin_folder(path, n, sizeoff, sizes, links):
+	"""folder n; links is the flddev/inos/nlinks/allocs sections, or None"""
+	i0 = sizeoff[n]
+	i1 = sizeoff[n + 1]
+	if not links or i0 == i1 or not links[2][i0]:
+		return Folder(path, sizes[i0:i1], presorted=True)
+	
+	return Folder(path, sizes[i0:i1], links[0][n],
+		*[arr[i0:i1] for arr in links[1:]], presorted=True)
+
+
+def _bin_links(bf):
+	"""sections with the link info, or None if the file predates them"""
+	if b'inos' not in bf.sections:
+		return None
+	
+	return [bf.get(x) for x in [b'flddev', b'inos', b'nlinks', b'allocs']]
+
+
+def _bin_load_strings(bf):
+	strtab = bf.get(b'strtab')
+	stroff = bf.get(b'stroff')
+	return [bytes(strtab[stroff[n] : stroff[n + 1]]).decode(
+		'utf-8', ENC_FILTER) for n in range(len(stroff) - 1)]
+
+
+def _bin_load_folders(bf, paths):
+	"""the folders, given their paths (or path ids)"""
+	sizeoff = bf.get(b'sizeoff')
+	sizes = bf.get(b'sizes')
+	links = _bin_links(bf)
+	folders = []
+	for n, path in enumerate(paths):
+		folders.append(_bin_folder(path, n, sizeoff, sizes, links))
+	
+	return folders
+
+
+def _bin_paths(pids):
+	"""
+	the part of PATHS needed by the path ids; the names as a string
+	table, and the parent of each (ids renumbered in the same order,
+	so parents still come first). Returns the sections and {id: new id}
+	"""
+	need = set()
+	for pid in pids:
+		while pid >= 0 and pid not in need:
+			need.add(pid)
+			pid = PATHS.parents[pid]
+	
+	order = sorted(need)
+	renum = dict((pid, n) for n, pid in enumerate(order))
+	renum[-1] = -1
+	sections = _bin_strings(PATHS.names[pid] for pid in order)
+	sections.append((b'pathpar', array.array(I64,
+		[renum[PATHS.parents[pid]] for pid in order])))
+	
+	return sections, renum
+
+
+def _bin_load_paths(bf):
+	"""adds the path table of the file to PATHS; returns their ids"""
+	ret = []
+	for parent, name in zip(bf.get(b'pathpar'), _bin_load_strings(bf)):
+		ret.append(PATHS.child(ret[parent] if parent >= 0 else -1, name))
+	
+	return ret
+
+
+def _txt_folder(fld):
+	"""a folder in the text formats; link info (if any) goes first"""
+	txt = ''
+	if fld.inos:
+		txt = 'i {} {}\n'.format(fld.dev, ' '.join(
+			'{}:{}:{}'.format(*x) for x in zip(fld.inos, fld.nlinks, fld.allocs)))
+	
+	return txt + 'p {}\nf {}\n'.format(fld.path,
+		' '.join(str(x) for x in fld.files))
+
+
+def _txt_links(ln):
+	"""keyword args for the Folder of the p line after this i line"""
+	dev, links = ln[2:].split(' ', 1)
+	links = [[int(x) for x in link.split(':')] for link in links.split(' ')]
+	inos, nlinks, allocs = zip(*links)
+	return {'dev': int(dev), 'inos': inos, 'nlinks': nlinks, 'allocs': allocs}
+
+
+# inode and mtime of a directory which could not be listed; never reused
+NO_META = (0, -1)
+
+
+def save_snapshot(snap_path, folders, dirs, textfmt=False):
+	"""
+	the folders worth matching (and the source of each), followed by
+	the inode and mtime of every directory that was walked (for
+	incremental rescans); the binary format has the paths as a table
+	of (parent, name)
+	"""
+	if not textfmt:
+		sections, renum = _bin_paths(itertools.chain(
+			(fld.pid for fld in folders),
+			(pid for pid, _ in dirs)))
+		
+		sections.extend(_bin_folders(folders))
+		sections.append((b'fldpath', array.array(U64,
+			[renum[fld.pid] for fld in folders])))
+		
+		sections.append((b'fldsrc', array.array('I',
+			[fld.src for fld in folders])))
+		
+		sections.append((b'dirpath', array.array(U64,
+			[renum[pid] for pid, _ in dirs])))
+		
+		metas = [meta or NO_META for _, meta in dirs]
+		sections.append((b'dirino', array.array(U64, [x[0] for x in metas])))
+		sections.append((b'dirmtime', array.array(I64, [x[1] for x in metas])))
+		bin_save(snap_path, b'snap', sections)
+		return
+	
+	with gzip.open(snap_path, 'wb') as f:
+		for fld in folders:
+			txt = _txt_folder(fld)
+			if fld.src:
+				txt = 's {}\n'.format(fld.src) + txt
+			
+			f.write(txt.encode('utf-8', ENC_FILTER))
+		
+		for pid, meta in dirs:
+			ino, mtime = meta or NO_META
+			txt = 'd {} {} {}\n'.format(ino, mtime, PATHS.path(pid))
+			f.write(txt.encode('utf-8', ENC_FILTER))
+		
+		f.write(b'eof\n')
+
+
+def load_snapshot(snap_path):
+	if is_binfile(snap_path):
+		bf = BinFile(snap_path, b'snap')
+		nfolders = len(bf.get(b'sizeoff')) - 1
+		if b'pathpar' in bf.sections:
+			pids = _bin_load_paths(bf)
+			fld_pids = [pids[n] for n in bf.get(b'fldpath')]
+			dir_pids = [pids[n] for n in bf.get(b'dirpath')]
+		else:
+			# full paths; folders then dirs
+			paths = _bin_load_strings(bf)
+			fld_pids = paths[:nfolders]
+			dir_pids = [PATHS.add(x) for x in paths[nfolders:]]
+		
+		folders = _bin_load_folders(bf, fld_pids)
+		if b'fldsrc' in bf.sections:
+			for fld, src in zip(folders, bf.get(b'fldsrc')):
+				fld.src = src
+		
+		dirs = list(zip(dir_pids, zip(
+			bf.get(b'dirino'), bf.get(b'dirmtime'))))
+		
+		return folders, dirs
+	
+	folders = []
+	dirs = []
+	links = {}
+	src = 0
+	with gzip.open(snap_path, 'rb') as f:
+		while True:
+			ln = f.readline()[:-1].decode('utf-8', ENC_FILTER)
+			if ln == 'eof':
+				break
+			
+			if ln.startswith('d '):
+				ino, mtime, path = ln[2:].split(' ', 2)
+				dirs.append((PATHS.add(path), (int(ino), int(mtime))))
+				continue
+			
+			if ln.startswith('s '):
+				src = int(ln[2:])
+				continue
+			
+			if ln.startswith('i '):
+				links = _txt_links(ln)
+				continue
+			
+			if not ln.startswith('p '):
+				raise Exception('p expected, got ' + ln)
+			
+			ln2 = f.readline()[:-1].decode('utf-8')
+			if not ln2.startswith('f '):
+				raise Exception('f expected, got ' + ln2)
+				
+			folder = Folder(ln[2:],
+				[int(sz) for sz in ln2[2:].split(' ')], src=src, **links)
+			
+			folders.append(folder)
+			links = {}
+			src = 0
+	
+	return folders, dirs
+
+
+def snapshot_index(folders, dirs):
+	"""
+	{path id: ((inode, mtime), Folder or None, subdirectories)} for
+	DiskWalker; the subdirectories are kept in the order they were walked
+	"""
+	by_pid = dict((fld.pid, fld) for fld in folders)
+	ret = {}
+	for pid, meta in dirs:
+		fld = by_pid.get(pid)
+		if fld and not fld.inos:
+			meta = None  # from an older version; list it again
+		
+		ret[pid] = (meta, fld, [])
+	
+	for pid, _ in dirs:
+		# dirname rather than the parent id since "/" is ("", "")
+		path = PATHS.path(pid)
+		parent = os.path.dirname(path)
+		if parent != path:
+			parent = PATHS.add(parent)
+			if parent in ret:
+				ret[parent][2].append(pid)
+	
+	return ret
+
+
+def gen_dupe_map(roots, snap_path, engine=DEFAULT_ENGINE, jobs=1,
+	rescan=False, textfmt=False, hashdb=None, stop_df=0, stop_min=0,
+	cross=False):
+	print("\nscanning disk...")
+	
+	t0 = time.time()
+	folders = []
+	errors = []
+	
+	prev = None
+	if os.path.isfile(snap_path):
+		folders, dirs = load_snapshot(snap_path)
+		if rescan:
+			prev = snapshot_index(folders, dirs)
+			folders = []
+	
+	if prev is not None or not os.path.isfile(snap_path):
+		dirs = []
+		for src, (root, nthreads) in enumerate(roots):
+			dw = DiskWalker(root, nthreads, prev)
+			for fld in dw.folders:
+				fld.src = src
+			
+			folders.extend(dw.folders)
+			errors.extend(dw.errors)
+			dirs.extend(dw.dirs)
+	
+	if errors:
+		print('{} errors occurred:'.format(len(errors)))
+		for error in errors:
+			print(error)
+		
+		print('these will be repeated after the dupemap generation finishes')
+	
+	if prev is not None or not os.path.isfile(snap_path):
+		print("\ndumping snapshot to", snap_path)
+		save_snapshot(snap_path, folders, dirs, textfmt)
+	
+	if hashdb:
+		print('{} files have hashes in the hashdb'.format(
+			hashdb.fill_folders(folders)))
+	
+	print("generating dupemap (hope you're using pypy w)")
+
+	t1 = time.time()
+	dupes = match_folders(folders, engine, jobs, stop_df, stop_min, cross)
+	t2 = time.time()
+	
+	if errors:
+		print('\nok so about those errors from before,')
+		for error in errors:
+			print(error)
+		
+		print('\nare these {} errors ok? press ENTER to continue or CTRL-C'.format(len(errors)))
+		input()
+	
+	return dupes, (t1-t0, t2-t1)
+
+
+def save_dupe_map(cache_path, dupes, textfmt=False):
+	if not textfmt:
+		folders = []
+		seen_folders = {}
+		pairs = [array.array('I') for _ in range(3)]
+		for score, fld1, fld2 in dupes:
+			pairs[0].append(int(score*1000))
+			for fld, ids in [(fld1, pairs[1]), (fld2, pairs[2])]:
+				if fld not in seen_folders:
+					seen_folders[fld] = len(folders)
+					folders.append(fld)
+				
+				ids.append(seen_folders[fld])
+		
+		sections = _bin_strings(fld.path for fld in folders)
+		sections.extend(_bin_folders(folders))
+		sections.extend(zip([b'score', b'fld1', b'fld2'], pairs))
+		bin_save(cache_path, b'dupe', sections)
+		return
+	
+	with gzip.open(cache_path, 'wb') as f:
+		seen_folders = {}
+		n = 0
+		
+		# serialize folders that contain dupes
+		for _, fld1, fld2 in dupes:
+			for fld in (fld1, fld2):
+				if fld not in seen_folders:
+					f.write(_txt_folder(fld).encode('utf-8', ENC_FILTER))
+					seen_folders[fld] = n
+					n += 1
+		
+		# serialize dupe info
+		for score, fld1, fld2 in dupes:
+			f.write('d {} {} {}\n'.format(
+				int(score*1000),
+				seen_folders[fld1],
+				seen_folders[fld2]).encode('utf-8'))
+		
+		f.write(b'eof\n')
+
+
+def load_dupe_map(cache_path):
+	if is_binfile(cache_path):
+		bf = BinFile(cache_path, b'dupe')
+		folders = _bin_load_folders(bf, _bin_load_strings(bf))
+		return [(score/1000., folders[i1], folders[i2])
+			for score, i1, i2 in zip(
+				bf.get(b'score'), bf.get(b'fld1'), bf.get(b'fld2'))]
+	
+	folders = []
+	dupes = []
+	links = {}
+	with gzip.open(cache_path, 'rb') as f:
+		while True:
+			ln = f.readline()[:-1].decode('utf-8', ENC_FILTER)
+			if ln.startswith('i '):
+				links = _txt_links(ln)
+				continue
+			
+			if ln.startswith('p '):
+				ln2 = f.readline()[:-1].decode('utf-8')
+				if not ln2.startswith('f '):
+					raise Exception('non-f after p')
+				
+				folder = Folder(ln[2:],
+					[int(sz) for sz in ln2[2:].split(' ')], **links)
+				
+				folders.append(folder)
+				links = {}
+				continue
+			
+			if ln.startswith('d '):
+				score, i1, i2 = [int(x) for x in ln[2:].split(' ')]
+				dupes.append((score/1000., folders[i1], folders[i2]))
+				continue
+			
+			if ln == 'eof':
+				break
+			
+			raise Exception('unexpected line: {}'.format(ln))
+
+	return dupes
+
+
+class DupeList(list):
+	"""
+	[(score, Folder, Folder), ...] which is fully loaded
+	and was checked for deleted folders when loading
+	"""
+	firsts = None
+	
+	def find(self, path):
+		"""index of the first pair with path on the left, else right"""
+		if self.firsts is None:
+			self.firsts = {}
+			for side in [1, 2]:
+				for n, dupe in enumerate(self):
+					self.firsts.setdefault(dupe[side].path, n)
+		
+		return self.firsts.get(path)
+	
+	def is_live(self, n):
+		return True
+	
+	def prefetch(self, n, step=1):
+		pass
+	
+	def loaded_folders(self):
+		seen = {}
+		for _, fld1, fld2 in self:
+			for fld in [fld1, fld2]:
+				if fld not in seen:
+					seen[fld] = 1
+					yield fld
+
+
+class LazyDupes(object):
+	"""
+	the binary dupe cache as a sequence of (score, Folder, Folder),
+	only decoding the pairs which are actually looked at;
+	deleted folders are detected as they are about to be shown
+	"""
+	def __init__(self, cache_path):
+		bf = BinFile(cache_path, b'dupe')
+		self.bf = bf
+		self.scores = bf.get(b'score')
+		self.ids1 = bf.get(b'fld1')
+		self.ids2 = bf.get(b'fld2')
+		self.strtab = bf.get(b'strtab')
+		self.stroff = bf.get(b'stroff')
+		self.sizeoff = bf.get(b'sizeoff')
+		self.sizes = bf.get(b'sizes')
+		self.links = _bin_links(bf)
+		
+		self.folders = {}
+		self.exists = {}
+		self.firsts = None
+		self.on_load = None
+		self.prefetch_at = None
+		self.prefetch_thr = None
+	
+	def __len__(self):
+		return len(self.scores)
+	
+	def __getitem__(self, n):
+		if n < 0:
+			n += len(self.scores)
+		
+		if n < 0 or n >= len(self.scores):
+			raise IndexError(n)
+		
+		return (self.scores[n]/1000.,
+			self.folder(self.ids1[n]),
+			self.folder(self.ids2[n]))
+	
+	def path(self, fid):
+		path = self.strtab[self.stroff[fid] : self.stroff[fid + 1]]
+		return bytes(path).decode('utf-8', ENC_FILTER)
+	
+	def folder(self, fid):
+		try:
+			return self.folders[fid]
+		except KeyError:
+			pass
+		
+		fld = _bin_folder(self.path(fid),
+			fid, self.sizeoff, self.sizes, self.links)
+		
+		self.folders[fid] = fld
+		if self.on_load:
+			self.on_load(fld)
+		
+		return fld
+	
+	def find(self, path):
+		"""index of the first pair with path on the left, else right"""
+		if self.firsts is None:
+			by_fid = {}
+			for ids in [self.ids1, self.ids2]:
+				for n, fid in enumerate(ids):
+					by_fid.setdefault(fid, n)
+			
+			self.firsts = dict((self.path(fid), n) for fid, n in by_fid.items())
+		
+		return self.firsts.get(path)
+	
+	def is_live(self, n):
+		"""whether both folders of pair n still exist"""
+		ret = True
+		for fid in [self.ids1[n], self.ids2[n]]:
+			try:
+				ok = self.exists[fid]
+			except KeyError:
+				ok = self.exists[fid] = os.path.exists(fsenc(self.path(fid)))
+			
+			ret = ret and ok
+		
+		return ret
+	
+	def prefetch(self, n, step=1):
+		"""check if the next few pairs still exist, in the background"""
+		self.prefetch_at = (n, step)
+		if self.prefetch_thr and self.prefetch_thr.is_alive():
+			return
+		
+		self.prefetch_thr = threading.Thread(target=self._prefetch)
+		self.prefetch_thr.daemon = True
+		self.prefetch_thr.start()
+	
+	def _prefetch(self):
+		ndupes = len(self.scores)
+		while True:
+			at = self.prefetch_at
+			n, step = at
+			for x in range(1, min(32, ndupes)):
+				x = (n + x * step) % ndupes
+				if self.ids1[x] not in self.exists \
+				or self.ids2[x] not in self.exists:
+					self.is_live(x)
+				
+				if at != self.prefetch_at:
+					break
+			
+			if at == self.prefetch_at:
+				return
+	
+	def loaded_folders(self):
+		return list(self.folders.values())
+
+
+def convert(src, dst):
+	"""
+	binary snapshot/cache to text and back; text caches are told apart
+	from snapshots by their all-numeric "d score fld1 fld2" lines
+	"""
+	if is_binfile(src):
+		textfmt = True
+		with open(src, 'rb') as f:
+			is_snap = f.read(12)[8:] == b'snap'
+	else:
+		textfmt = False
+		is_snap = True
+		with gzip.open(src, 'rb') as f:
+			for ln in f:
+				if ln.startswith(b'd ') and re.match(b'^d [0-9]+ [0-9]+ [0-9]+$', ln.rstrip()):
+					is_snap = False
+					break
+	
+	if is_snap:
+		folders, dirs = load_snapshot(src)
+		save_snapshot(dst, folders, dirs, textfmt)
+	else:
+		save_dupe_map(dst, load_dupe_map(src), textfmt)
+	
+	print('wrote {} as {}'.format(dst, 'text' if textfmt else 'binary'))
+
+
+def colorize_score(score):
+	if score == "xxx":
+		return '0;37', score
+	
+	if score < 0.2:
+		c = '1;30'
+	elif score < 0.35:
+		c = '0;31'
+	elif score < 0.5:
+		c = '0;36'
+	elif score < 0.7:
+		c = '0;33'
+	elif score < 0.9:
+		c = '1;32'
+	elif score <= 1:
+		c = '1;37;44;48;5;28'
+	else:
+		c = '1;37;41'
+	
+	return c, int(score*100)
+
+
+def dump_summary(dupes):
+	# keep track of the 1st folder in the pair,
 	# print it as a header for all the folders it matched against
 	last_lhs = None
 	for score, lhs, rhs in dupes:
@@ -744,7 +2418,7 @@ def read_folder(top):
 	return ret
 
 
-def draw_panel(panel_w, stf, other_sizes, htab1, htab2, inverted_hilight):
+def draw_panel(panel_w, stf, other_sizes, htab1, htab2, stab1, stab2, inverted_hilight):
 	htab1 = dict(htab1)
 	htab2 = dict(htab2)
 	lines = []
@@ -756,6 +2430,7 @@ def draw_panel(panel_w, stf, other_sizes, htab1, htab2, inverted_hilight):
 	white = '1;30;47'
 	yellow = '1;30;43'
 	blue = '1;30;44'
+	cyan = '1;30;46'
 	green = '1;37;44;48;5;28'
 	red = '1;37;41'
 
@@ -764,6 +2439,7 @@ def draw_panel(panel_w, stf, other_sizes, htab1, htab2, inverted_hilight):
 		white = '1;37'
 		yellow = '1;33'
 		blue = '1;34'
+		cyan = '1;36'
 		green = '1;32'
 		# red = '1;31'
 
@@ -793,6 +2469,19 @@ def draw_panel(panel_w, stf, other_sizes, htab1, htab2, inverted_hilight):
 					elif 'x' in [hsha, hsha2]:
 						c = blue  # queued
 						bin_eq = False
+					elif '~' in [hsha, hsha2]:
+						samp = stab1.get(fn)
+						samp2 = stab2.get(fn2)
+						if not samp or not samp2:
+							c = blue  # still sampling
+						elif samp == samp2:
+							c = cyan  # sample-match, unverified
+						else:
+							c = red  # incorrect
+						bin_eq = False
+					elif hash_algo(hsha) != hash_algo(hsha2):
+						c = yellow  # different --hash
+						bin_eq = False
 					elif hsha == hsha2:
 						c = green  # match
 						bin_eq = True
@@ -832,43 +2521,48 @@ def draw_panel(panel_w, stf, other_sizes, htab1, htab2, inverted_hilight):
 
 class FSDir(object):
 	def __init__(self, path):
-		self.path = path
+		self.pid = PATHS.add(path)
 		self.dirs = {}
 		self.files = []
 		self.smin = 0
 		self.smax = -9
 		self.scur = -2  # extralevel (unvisited)
 		self.dupesize = 0
+	
+	@property
+	def path(self):
+		return PATHS.path(self.pid)
 
 	def build_until(self, dest, extra_levels=1):
+		top = self.path
 		if extra_levels < 0 or (
-			not dest.startswith(self.path) \
-			and not self.path.startswith(dest)
+			not dest.startswith(top) \
+			and not top.startswith(dest)
 		):
 			raise Exception('\n[{}]  # self\n[{}]  # dest\n[{}]'.format(
-				self.path, dest, extra_levels))
+				top, dest, extra_levels))
 		
 		self.scur = -1  # visited + zero files
-		if self.path.startswith(dest):
+		if top.startswith(dest):
 			extra_levels -= 1
 		
 		if self.files or self.dirs:
 			if extra_levels > 0:
-				dn = dest[len(self.path):].split(os.sep, 1)[0]
+				dn = dest[len(top):].split(os.sep, 1)[0]
 				self.dirs[dn].build_until(dest, extra_levels)
 			
 			return
 
-		if not self.path:
+		if not top:
 			# windows
 			n = dest.split(os.sep)[0]
 			self.dirs[n] = FSDir(n + os.sep)
 			return
 
-		bself = fsenc(self.path)
-		for bfn, sr in statdir(print, bself, True):
+		btop = fsenc(top)
+		for bfn, sr in statdir(print, btop, True):
 			fn = fsdec(os.path.basename(bfn))
-			path = os.path.join(self.path, fn)
+			path = os.path.join(top, fn)
 			mode = sr.st_mode
 
 			if stat.S_ISREG(mode):
@@ -908,15 +2602,16 @@ class FSDir(object):
 		
 		# not all folders shown are dupes so don't necessarily have a fld,
 		# so using self.path since ram is cheap anyways
+		path = self.path
 		ret.append([
-			self.path,
+			path,
 			scores,
 			'\033[{sz_c}m{sz_v:>5}\033[0m {pad}\033[0;3{cdir}m{path}\033[0m'.format(
 				sz_c = sz_c,
 				sz_v = int(sz_v),
 				pad = '{}\033[1;3{}m|'.format(' ' * (lv * 2 - 1), lv%8) if lv else '',
 				cdir = cmap[cdir],
-				path = self.path)])
+				path = path)])
 		
 		for _, p in sorted(self.dirs.items()):
 			p.gen(ret, cmap, lv + 1)
@@ -940,22 +2635,18 @@ class FSDir(object):
 
 
 def get_dupe_size(fld1, fld2):
-	ret = 0
-	rhs = fld2.files[:]
-	for sz in fld1.files:
-		if sz in rhs:
-			ret += sz
-			rhs.remove(sz)
-
-	return ret
+	return pair_reclaim(fld1, fld2)
 
 
 class GetchInterp(object):
 	def __init__(self):
 		self.hist = ''
 
-	def g(self):
-		c = getch()
+	def g(self, timeout=None, waker=None):
+		c = getch(timeout, waker)
+		if c is None:
+			return None
+		
 		if c == '\033':
 			self.hist = c
 			return None
@@ -973,19 +2664,95 @@ class GetchInterp(object):
 			if c == 'B':
 				return 'scroll_down'
 		
-		self.hist = None
-		return c
+		self.hist = None
+		return c
+
+
+class Waker(object):
+	"""lets other threads interrupt a getch() which is waiting for a key"""
+	def __init__(self):
+		self.evt = threading.Event()
+		self.rfd = self.wfd = None
+		if not WINDOWS:
+			self.rfd, self.wfd = os.pipe()
+			for fd in [self.rfd, self.wfd]:
+				flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+				fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+	
+	def wake(self):
+		self.evt.set()
+		if self.wfd is not None:
+			try:
+				os.write(self.wfd, b'.')
+			except OSError:
+				pass  # pipe is full, so it's awake already
+	
+	def clear(self):
+		self.evt.clear()
+		if self.rfd is not None:
+			try:
+				while os.read(self.rfd, 4096):
+					pass
+			except OSError:
+				pass
+	
+	def close(self):
+		for fd in [self.rfd, self.wfd]:
+			if fd is not None:
+				os.close(fd)
+		
+		self.rfd = self.wfd = None
 
 
 class TUI(object):
 	def __init__(self, cur_path):
 		self.gen_time = [0,0]
+		self.hashd = None
 		self.cur_path = cur_path
 		self.set_dupes(None)
 		
 		self.getch = GetchInterp().g
 		self.inverted_hilight = False
 
+	def hash_stats(self):
+		h = self.hashd
+		if not h or not h.hits + h.misses:
+			return ''
+		
+		ret = '  \033[32m{}h {:.1f}G \033[33m{}m {:.1f}G'.format(
+			h.hits, h.hit_bytes / (1024. ** 3),
+			h.misses, h.miss_bytes / (1024. ** 3))
+		
+		nfiles, nbytes = h.queued()
+		if nfiles:
+			ret += ' \033[36mq{} {:.1f}G'.format(nfiles, nbytes / (1024. ** 3))
+		
+		for name, speed in h.speeds():
+			ret += ' \033[35m{} {:.0f}M/s'.format(name, speed)
+		
+		if h.errors:
+			ret += ' \033[31m{}e'.format(len(h.errors))
+		
+		return ret
+	
+	def wait_key(self):
+		"""
+		the next key, or None when it's time to redraw since
+		hashes of the shown pair were completed, or to update
+		the hashing progress once a second
+		"""
+		h = self.hashd
+		if not h:
+			return self.getch()
+		
+		ch = self.getch(1 if h.busy() else None, h.waker)
+		if ch is None and h.waker.evt.is_set():
+			# hashes tend to land in bursts; gather a few per redraw
+			time.sleep(0.15)
+			h.waker.clear()
+		
+		return ch
+	
 	def set_dupes(self, dupes):
 		self.fcmp_idx = 0
 		self.dupes = dupes
@@ -1242,11 +3009,9 @@ press ENTER to quit this help view
 							continue
 						
 						needle = tree[n][0][:-1]
-						for _, fld1, fld2 in self.dupes:
-							for fld in [fld1, fld2]:
-								if needle == fld.path:
-									self.cur_path = fld.path
-									return ch, None
+						if self.dupes.find(needle) is not None:
+							self.cur_path = needle
+							return ch, None
 				
 				# can't be helped
 				self.cur_path = self.dupes[0][1].path
@@ -1255,37 +3020,35 @@ press ENTER to quit this help view
 			if ch in ['r', 'u', 'v']:
 				return ch, None
 
+	def step_pair(self, step):
+		"""
+		move fcmp_idx by step, and on past pairs where
+		a folder was deleted since the scan
+		"""
+		for _ in range(len(self.dupes)):
+			self.fcmp_idx = (self.fcmp_idx + step) % len(self.dupes)
+			if self.dupes.is_live(self.fcmp_idx):
+				break
+	
 	def foldercomp(self):
 		if self.cur_path != self.dupes[self.fcmp_idx][1].path:
-			ok = False
-			self.fcmp_idx = 0
-			for side in [1, 2]:
-				for n, dupe_obj in enumerate(self.dupes):
-					if dupe_obj[side].path == self.cur_path:
-						self.fcmp_idx = n
-						ok = True
-						break
-				
-				if ok:
-					break
+			self.fcmp_idx = self.dupes.find(self.cur_path) or 0
+		
+		if not self.dupes.is_live(self.fcmp_idx):
+			self.step_pair(1)
 		
+		self.dupes.prefetch(self.fcmp_idx)
 		ch = None
 		scr_y = 0
 		while True:
 			scr_w, scr_h = termsize()
 			panel_w = int(((scr_w + 1) / 2) - 1)
 			
-			if ch == 'a':
-				scr_y = 0
-				self.fcmp_idx -= 1
-				if self.fcmp_idx < 0:
-					self.fcmp_idx = len(self.dupes)-1
-			
-			if ch == 'd':
+			if ch in ['a', 'd']:
 				scr_y = 0
-				self.fcmp_idx += 1
-				if self.fcmp_idx >= len(self.dupes):
-					self.fcmp_idx = 0
+				step = 1 if ch == 'd' else -1
+				self.step_pair(step)
+				self.dupes.prefetch(self.fcmp_idx, step)
 
 			if ch == '?':
 				print("""
@@ -1294,7 +3057,8 @@ W/S = scroll
 A/D = switch folders
   Q = toggle tree-view
   H = initiate file hashing to compare file contents;
-       tap spacebar or switch folders (A/D) to refresh
+       files turn green/red as they are hashed
+       (cyan = sampled blocks match, full hash pending)
        (press H in multiple folders to queue them)
   E = open folders in ranger (linux) or explorer (windows)
   V = invert diff hilight colors
@@ -1313,6 +3077,8 @@ press ENTER to quit this help view
 
 			score, fld1, fld2 = self.dupes[self.fcmp_idx]
 			self.cur_path = fld1.path
+			if self.hashd:
+				self.hashd.focus(self.dupes, self.fcmp_idx)
 			
 			if ch == 'e':
 				# very safe assumption that urxvt and host has the same font size
@@ -1353,7 +3119,7 @@ press ENTER to quit this help view
 			else:
 				sz_c = '1;37;44'
 			
-			scrn = '\033[H\033[0;1;40m{idupe} / {ndupes}  \033[{sc_c}m{sc_v}%\033[0;40m  \033[{sz_c}m{sz_v}\033[0;40mMB  ←dupe→  ↑screen↓  ?/E/Q  \033[0;36;40m{gt1:.2f}s + {gt2:.2f}s\n\033[0m'.format(
+			scrn = '\033[H\033[0;1;40m{idupe} / {ndupes}  \033[{sc_c}m{sc_v}%\033[0;40m  \033[{sz_c}m{sz_v}\033[0;40mMB  ←dupe→  ↑screen↓  ?/E/Q  \033[0;36;40m{gt1:.2f}s + {gt2:.2f}s{hstat}\n\033[0m'.format(
 				idupe = self.fcmp_idx + 1,
 				ndupes = len(self.dupes),
 				sc_c = csc[0],
@@ -1361,7 +3127,8 @@ press ENTER to quit this help view
 				sz_c = sz_c,
 				sz_v = sz_v,
 				gt1 = self.gen_time[0],
-				gt2 = self.gen_time[1]
+				gt2 = self.gen_time[1],
+				hstat = self.hash_stats()
 			)
 			
 			# adding the two folder paths,
@@ -1423,8 +3190,8 @@ press ENTER to quit this help view
 			
 			stf1, sizes1 = asdf(fld1)
 			stf2, sizes2 = asdf(fld2)
-			pan1, dupefiles1 = draw_panel(panel_w, stf1, sizes2, fld1.hashes, fld2.hashes, self.inverted_hilight)
-			pan2, dupefiles2 = draw_panel(panel_w, stf2, sizes1, fld2.hashes, fld1.hashes, self.inverted_hilight)
+			pan1, dupefiles1 = draw_panel(panel_w, stf1, sizes2, fld1.hashes, fld2.hashes, fld1.samples, fld2.samples, self.inverted_hilight)
+			pan2, dupefiles2 = draw_panel(panel_w, stf2, sizes1, fld2.hashes, fld1.hashes, fld2.samples, fld1.samples, self.inverted_hilight)
 			file_rows = []
 			
 			# this is probably where the view branches will merge
@@ -1480,7 +3247,7 @@ press ENTER to quit this help view
 			else:
 				wprint(scrn)
 			
-			ch = self.getch()
+			ch = self.wait_key()
 			print('\033[G\r\033[K', end='')  # repurpose last line
 			
 			if ch == '\003':
@@ -1528,6 +3295,8 @@ press ENTER to quit this help view
 					for got_hash, fn in nuke_files:
 						try:
 							_, _, expect = nuke_fld.hashes[fn]
+							if expect in ['x', '~']:
+								continue  # queued or only sampled
 						except:
 							continue
 						
@@ -1627,7 +3396,161 @@ press ENTER to quit this help view
 				return ch, ret
 
 
-def hashfile(fpath, fsize, prefix):
+def tag_hash(algo, digest):
+	"""
+	base64 of the digest, prefixed with the algorithm
+	so hashes from different algorithms never compare equal
+	"""
+	b64 = base64.b64encode(digest).decode('ascii').rstrip('=')
+	return '{}:{}'.format(algo, b64)
+
+
+def hash_algo(tagged):
+	return tagged.split(':', 1)[0]
+
+
+def hash_algos():
+	"""hashlib algorithms which are usable for --hash"""
+	ret = []
+	for algo in sorted(hashlib.algorithms_available):
+		try:
+			hashlib.new(algo).digest()
+			ret.append(algo)
+		except:
+			pass  # variable-length (shake) or unavailable
+	
+	return ret
+
+
+# option: read size when hashing files (--hash-chunk)
+HASH_CHUNK = 1024 * 1024
+
+# evict hashed data from the page cache this often
+FADV_STEP = 64 * 1024 * 1024
+
+FADVISE = hasattr(os, 'posix_fadvise')
+
+
+def read_hash(fpath, hasher, chunk=HASH_CHUNK, abort=None, progress=None):
+	"""
+	feeds the file into the hasher through one reused buffer;
+	on linux it also asks for aggressive readahead and evicts
+	hashed data from the page cache, so hashing a few TiB
+	doesn't push out everything else that was cached.
+	returns the number of bytes read, or None if abort was set;
+	progress is called with the size of each chunk
+	"""
+	buf = bytearray(chunk)
+	view = memoryview(buf)
+	pos = 0
+	with open(fsenc(fpath), 'rb', 0) as f:
+		fd = f.fileno()
+		if FADVISE:
+			os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+		
+		dropped = 0
+		while True:
+			n = f.readinto(buf)
+			if not n:
+				break
+			
+			if abort and abort.is_set():
+				pos = None
+				break
+			
+			hasher.update(view[:n])
+			pos += n
+			if progress:
+				progress(n)
+			if FADVISE and pos - dropped >= FADV_STEP:
+				os.posix_fadvise(fd, dropped, pos - dropped, os.POSIX_FADV_DONTNEED)
+				dropped = pos
+		
+		if FADVISE:
+			os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+	
+	return pos
+
+
+def _page_cache():
+	"""MiB in the page cache (linux), or None"""
+	try:
+		with open('/proc/meminfo', 'rb') as f:
+			for ln in f:
+				if ln.startswith(b'Cached:'):
+					return int(ln.split()[1]) / 1024.
+	except:
+		pass
+	
+	return None
+
+
+def _bench_hash(mode, fpath, chunk, algo):
+	"""one run of --bench-hash, in a fresh process so the rss is its own"""
+	try:
+		import resource
+		rss_div = 1024. * (1024 if sys.platform == 'darwin' else 1)
+		get_rss = lambda: resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / rss_div
+	except ImportError:
+		get_rss = lambda: None
+	
+	if FADVISE:
+		# start cold, same as a file which wasn't read recently
+		with open(fsenc(fpath), 'rb') as f:
+			os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+	
+	cache0 = _page_cache()
+	rss0 = get_rss()
+	t0 = time.time()
+	hasher = hashlib.new(algo)
+	if mode == 'read':
+		nbytes = 0
+		with open(fsenc(fpath), 'rb', 512*1024) as f:
+			while True:
+				data = f.read(512*1024)
+				if not data:
+					break
+				
+				hasher.update(data)
+				nbytes += len(data)
+	else:
+		nbytes = read_hash(fpath, hasher, chunk)
+	
+	hasher.digest()
+	secs = time.time() - t0
+	rss1 = get_rss()
+	cache1 = _page_cache()
+	rss = None if rss0 is None else rss1 - rss0
+	cache = None if cache0 is None else cache1 - cache0
+	return secs, nbytes, rss, cache
+
+
+def bench_hash(fpath, chunk=HASH_CHUNK, algo='sha1'):
+	"""compare the old read() loop with read_hash; speed, memory, page cache"""
+	import multiprocessing
+	
+	print('hashing {} with {}, starting cold each time'.format(fpath, algo))
+	if not FADVISE:
+		print('(no posix_fadvise here, so the second run may be served from cache)')
+	
+	fmt = lambda v: '?' if v is None else '{:+.1f}'.format(v)
+	for mode, desc in [
+		['read', 'read(512 KiB)'],
+		['readinto', 'readinto({} KiB) + fadvise'.format(chunk // 1024)]
+	]:
+		pool = multiprocessing.Pool(1)
+		try:
+			secs, nbytes, rss, cache = pool.apply(
+				_bench_hash, (mode, fpath, chunk, algo))
+		finally:
+			pool.terminate()
+			pool.join()
+		
+		print('{:32} {:9.1f} MiB/s, max rss {} MiB, page cache {} MiB'.format(
+			desc, nbytes / (1024. * 1024) / max(secs, 0.001), fmt(rss), fmt(cache)))
+
+
+def hashfile(fpath, fsize, prefix, algo='sha1'):
 	t0 = time.time()
 	fpos = 0
 	next_print = 0
@@ -1635,7 +3558,7 @@ def hashfile(fpath, fsize, prefix):
 	last_print_pos = 0
 	last_print_ts = t0
 	
-	hasher = hashlib.sha1()
+	hasher = hashlib.new(algo)
 	with open(fsenc(fpath), 'rb', 512*1024) as f:
 		while True:
 			if fpos >= next_print:
@@ -1646,193 +3569,1172 @@ def hashfile(fpath, fsize, prefix):
 					perc = 0
 					speed = 0
 				else:
-					perc = (100. * fpos) / fsize
-					speed = ((
-						(fpos - last_print_pos) /
-						(now - last_print_ts)) /
-						(1024. * 1024))
+					perc = (100. * fpos) / fsize
+					speed = ((
+						(fpos - last_print_pos) /
+						(now - last_print_ts)) /
+						(1024. * 1024))
+				
+				next_print += print_interval
+				print('\033[A{}{:6.2f}% @ {:8.2f} MiB/s  {}'.format(
+					prefix, perc, speed, fpath))
+			
+			data = f.read(512*1024)
+			if not data:
+				break
+			
+			hasher.update(data)
+			fpos += len(data)
+	
+	return tag_hash(algo, hasher.digest()), time.time() - t0
+
+
+def remove_deleted_folders(dupes):
+	# quickrefresh; drops deleted folders from cache
+	# (single deleted files is not worth)
+	tested = {}
+	ok = {}
+	ng = {}
+	newdupes = []
+	for dupe in dupes:
+		_, fld1, fld2 = dupe
+		paths = [fld1.path, fld2.path]
+		for path in paths:
+			if path in tested:
+				continue
+			
+			tested[path] = 1
+			
+			if os.path.exists(path):
+				ok[path] = 1
+			else:
+				print('forgetting', path)
+				ng[path] = 1
+		
+		if paths[0] in ok \
+		and paths[1] in ok:
+			newdupes.append(dupe)
+	
+	if ng:
+		print("""
+removed {} deleted folders from the cache
+(this removes {} dupes from the cache btw)
+hit ENTER to save and continue, or press CTRL-C
+""".format(len(ng.items()), len(dupes) - len(newdupes)))
+		input()
+
+	return ok, ng, newdupes
+
+
+def _dbstr(txt):
+	"""paths go into sqlite as blobs, since they may not be valid utf-8"""
+	ret = txt.encode('utf-8', ENC_FILTER)
+	return buffer(ret) if PY2 else ret  # pylint: disable=undefined-variable
+
+
+def _strdb(blob):
+	return bytes(blob).decode('utf-8', ENC_FILTER)
+
+
+class HashDB(object):
+	"""
+	file hashes in sqlite, indexed by folder+filename and by device+inode;
+	WAL mode so several smf processes can share it.
+	sha is the full hash, samp the hash of the sampled blocks
+	(either may be null)
+	"""
+	def __init__(self, db_path, log_path=None):
+		self.db_path = db_path
+		self.mtx = threading.Lock()
+		self.db = sqlite3.connect(db_path, timeout=60, check_same_thread=False)
+		self.db.execute('pragma journal_mode=wal')
+		self.db.execute('pragma synchronous=normal')
+		with self.db:
+			self.db.execute('''create table if not exists hashes (
+				dir blob, name blob, sz int, ts int, dev int, ino int, sha text,
+				mtime_ns int, primary key (dir, name))''')
+			
+			cols = [x[1] for x in self.db.execute('pragma table_info(hashes)')]
+			if 'mtime_ns' not in cols:
+				self.db.execute('alter table hashes add column mtime_ns int')
+			
+			if 'samp' not in cols:
+				self.db.execute('alter table hashes add column samp text')
+			
+			# hashes were untagged sha1 before --hash
+			if self.db.execute('pragma user_version').fetchone()[0] < 1:
+				for col in ['sha', 'samp']:
+					self.db.execute('''update hashes set {0} = 'sha1:' || {0}
+						where instr({0}, ':') = 0'''.format(col))
+				
+				self.db.execute('pragma user_version = 1')
+			
+			self.db.execute('''create index if not exists
+				hashes_ino on hashes (dev, ino)''')
+		
+		if log_path and os.path.exists(log_path):
+			self.import_log(log_path)
+	
+	def import_log(self, log_path):
+		"""migrate the old append-only smf.sha1 into the db"""
+		print('importing', log_path)
+		rows = []
+		with open(log_path, 'rb') as f:
+			for ln in f:
+				sha1, sz, ts, fpath = ln.decode('utf-8', ENC_FILTER).split(' ', 3)
+				rows.append(('sha1:' + sha1, int(sz), int(ts), fpath.rstrip('\n'), None, None, None, None))
+		
+		# later lines win, same as when it was loaded into a dict
+		self.put(rows)
+		os.rename(log_path, log_path + '.imported')
+	
+	def get(self, fpath):
+		"""(sz, ts, sha, dev, ino, mtime_ns, samp) of the file, or None"""
+		fdir, fname = os.path.split(fpath)
+		with self.mtx:
+			row = self.db.execute(
+				'''select sz, ts, sha, dev, ino, mtime_ns, samp from hashes
+				where dir = ? and name = ?''',
+				(_dbstr(fdir), _dbstr(fname))).fetchone()
+		
+		return tuple(row) if row else None
+	
+	def by_inode(self, dev, ino, sz, mtime_ns, algo):
+		"""hash of another path to the same unmodified file, or None"""
+		tag = algo + ':'
+		with self.mtx:
+			row = self.db.execute(
+				'''select sha from hashes where dev = ? and ino = ?
+				and sz = ? and mtime_ns = ? and substr(sha, 1, ?) = ?''',
+				(dev, ino, sz, mtime_ns, len(tag), tag)).fetchone()
+		
+		return row[0] if row else None
+	
+	def folder(self, fdir):
+		"""[(fname, sz, ts, sha, samp), ...] within the folder"""
+		with self.mtx:
+			rows = self.db.execute(
+				'select name, sz, ts, sha, samp from hashes where dir = ?',
+				(_dbstr(fdir),)).fetchall()
+		
+		return [(_strdb(x[0]),) + tuple(x[1:]) for x in rows]
+	
+	def fill_folders(self, folders):
+		"""
+		add the full hashes of files within the folders to their
+		.hashes for matching by content; only sizes which another
+		folder has too, and only if the file on disk still has the
+		same size and mtime; returns the number of files
+		"""
+		with self.mtx:
+			hashed = set(_strdb(x[0]) for x in self.db.execute(
+				'select distinct dir from hashes where sha is not null'))
+		
+		nsize = {}
+		for fld in folders:
+			for sz in set(fld.files):
+				nsize[sz] = nsize.get(sz, 0) + 1
+		
+		ret = 0
+		for fld in folders:
+			fdir = fld.path
+			if fdir not in hashed:
+				continue
+			
+			for fname, sz, ts, sha, _ in self.folder(fdir):
+				if not sha or nsize.get(sz, 0) < 2:
+					continue
+				
+				try:
+					sr = os.stat(fsenc(os.path.join(fdir, fname)))
+				except OSError:
+					continue
+				
+				if sr.st_size != sz or int(sr.st_mtime) != ts:
+					continue  # modified since
+				
+				fld.hashes[fname] = (sz, ts, sha)
+				ret += 1
+		
+		return ret
+	
+	def put(self, rows):
+		"""rows of (sha, sz, ts, fpath, dev, ino, mtime_ns, samp)"""
+		if not rows:
+			return
+		
+		args = []
+		for sha, sz, ts, fpath, dev, ino, mtime, samp in rows:
+			fdir, fname = os.path.split(fpath)
+			args.append((_dbstr(fdir), _dbstr(fname), sz, ts, dev, ino, sha, mtime, samp))
+		
+		with self.mtx:
+			with self.db:
+				self.db.executemany(
+					'''insert or replace into hashes
+					(dir, name, sz, ts, dev, ino, sha, mtime_ns, samp)
+					values (?,?,?,?,?,?,?,?,?)''', args)
+	
+	def compact(self):
+		"""forget hashes of files which were deleted or modified"""
+		with self.mtx:
+			rows = self.db.execute(
+				'select dir, name, sz, ts from hashes').fetchall()
+		
+		drop = []
+		for fdir, fname, sz, ts in rows:
+			fpath = os.path.join(_strdb(fdir), _strdb(fname))
+			try:
+				sr = os.stat(fsenc(fpath))
+				if sr.st_size == sz and int(sr.st_mtime) == ts:
+					continue
+			except:
+				pass
+			
+			drop.append((fdir, fname))
+		
+		with self.mtx:
+			with self.db:
+				self.db.executemany(
+					'delete from hashes where dir = ? and name = ?', drop)
+			
+			self.db.execute('vacuum')
+		
+		print('dropped {} of {} hashes from {}'.format(
+			len(drop), len(rows), self.db_path))
+
+
+# files are first compared by hashing a few blocks from the head,
+# tail and evenly spaced in between, and only fully hashed if those agree
+SAMPLE_BLOCK = 64 * 1024
+SAMPLE_COUNT = 8
+
+# below this, sampling would read most of the file anyway
+SAMPLE_MIN = SAMPLE_BLOCK * SAMPLE_COUNT * 2
+
+
+def plan_pair(fld1, stf1, fld2, stf2, force, algo):
+	"""
+	pairs up files of equal size in the two folder listings
+	(from read_folder) and returns the pairs which need hashing
+	as two aligned lists of (sz, ts, fname), marking them queued;
+	files which were only sampled so far, or hashed with
+	another algorithm, are included again
+	"""
+	def stale(fld, sz, ts, fn):
+		try:
+			hsz, hts, hsha = fld.hashes[fn]
+		except KeyError:
+			return True
+		
+		if hsha == 'x':
+			return force
+		
+		return force or hsz != sz or hts != ts or hash_algo(hsha) != algo
+	
+	stf2 = list(stf2)
+	files1 = []
+	files2 = []
+	for sz, ts, fn in stf1:
+		hit = next((x for x in stf2 if x[0] == sz and sz > 0), None)
+		if not hit:
+			continue
+		
+		stf2.remove(hit)
+		sz2, ts2, fn2 = hit
+		need1 = stale(fld1, sz, ts, fn)
+		need2 = stale(fld2, sz2, ts2, fn2)
+		if not need1 and not need2:
+			continue
+		
+		if need1:
+			fld1.hashes[fn] = (sz, ts, 'x')
+		
+		if need2:
+			fld2.hashes[fn2] = (sz2, ts2, 'x')
+		
+		files1.append((sz, ts, fn))
+		files2.append(hit)
+	
+	return files1, files2
+
+
+class PairJob(object):
+	"""
+	size-matched files of two folders on their way through the hashing
+	stages; files[0][n] and files[1][n] are the same size
+	"""
+	def __init__(self, fld1, fld2, files1, files2, seq, speculative=False):
+		self.flds = (fld1, fld2)
+		self.files = (files1, files2)
+		self.key = (fld1.path, fld2.path)
+		self.seq = seq
+		self.speculative = speculative
+		self.cancelled = False
+		self.devs = [None, None]
+		self.shas = ([None] * len(files1), [None] * len(files2))
+		self.samps = ([None] * len(files1), [None] * len(files2))
+		self.left = [2] * len(files1)  # sides left to sample
+	
+	def unverified(self, n):
+		"""
+		sides of file pair n to hash in full; both were sampled and
+		agree, or one side is already known in full (not sampled)
+		"""
+		sha1, sha2 = self.shas[0][n], self.shas[1][n]
+		samp1, samp2 = self.samps[0][n], self.samps[1][n]
+		if not (sha1 or samp1) or not (sha2 or samp2):
+			return []  # unreadable
+		
+		if samp1 and samp2 and samp1 != samp2:
+			return []  # different
+		
+		return [side for side, sha in enumerate([sha1, sha2]) if not sha]
+	
+	def forget(self, side, n):
+		"""file won't be hashed after all; unmark it as queued"""
+		hashes = self.flds[side].hashes
+		fname = self.files[side][n][2]
+		if hashes.get(fname, (0, 0, None))[2] == 'x':
+			hashes.pop(fname, None)
+
+
+# option: hashing threads per ssd/nvme (spinning disks get one)
+HASH_WORKERS_SSD = 4
+
+# option: folder pairs per device to pick the next file from (by rank);
+# any more wait in line, without holding up the ui
+HASH_QUEUE = 64
+
+# option: neighbours of the shown pair to sample while idle (0 = none)
+HASH_AHEAD = 3
+
+
+def dev_sysdir(dev_id):
+	"""the device in /sys/dev/block, or None (not linux, nfs, ...)"""
+	try:
+		ret = os.path.realpath('/sys/dev/block/{}:{}'.format(
+			os.major(dev_id), os.minor(dev_id)))
+		
+		return ret if os.path.isdir(ret) else None
+	except:
+		return None
+
+
+def dev_name(dev_id):
+	sysdir = dev_sysdir(dev_id)
+	if sysdir:
+		return os.path.basename(sysdir)
+	
+	try:
+		return '{}:{}'.format(os.major(dev_id), os.minor(dev_id))
+	except:
+		return str(dev_id)
+
+
+def dev_rotational(dev_id):
+	"""True for spinning disks, False for ssd/nvme, None if unknown"""
+	sysdir = dev_sysdir(dev_id)
+	if not sysdir:
+		return None
+	
+	# partitions have the queue info in their parent
+	for qdir in [sysdir, os.path.dirname(sysdir)]:
+		rot_path = os.path.join(qdir, 'queue', 'rotational')
+		try:
+			with open(rot_path, 'rb') as f:
+				return f.read().strip() != b'0'
+		except:
+			pass
+	
+	return None
+
+
+def dev_workers(dev_id):
+	"""
+	number of hashing threads for a device; one unless
+	/sys says it's not a spinning disk (or if there is no /sys)
+	"""
+	return HASH_WORKERS_SSD if dev_rotational(dev_id) is False else 1
+
+
+FS_IOC_FIEMAP = 0xC020660B
+
+
+def disk_order(fpath, sr):
+	"""
+	sort key placing files in the order they are on disk; the
+	physical offset of the first extent (FIEMAP) if the filesystem
+	tells, otherwise the inode number which is usually close enough
+	"""
+	try:
+		import fcntl
+		# struct fiemap with room for one struct fiemap_extent
+		buf = bytearray(struct.pack(
+			'=QQIIII', 0, 0xFFFFFFFFFFFFFFFF, 0, 0, 1, 0) + b'\0' * 56)
+		
+		with open(fsenc(fpath), 'rb') as f:
+			fcntl.ioctl(f.fileno(), FS_IOC_FIEMAP, buf)
+		
+		if struct.unpack_from('=I', buf, 20)[0]:
+			return (0, struct.unpack_from('=Q', buf, 40)[0])
+	except:
+		pass
+	
+	return (1, sr.st_ino)
+
+
+class HashPool(object):
+	"""
+	worker threads hashing files on one device; each file is taken
+	from the queued job which ranks first (see Hashd.rank) so the pair
+	being looked at jumps the queue. When maxsize jobs are queued, new
+	ones go to pending instead (except the shown pair, and followups)
+	and are moved over as jobs finish; put never blocks since it's
+	called from the ui thread
+	"""
+	def __init__(self, nworkers, maxsize, target, rank):
+		self.maxsize = maxsize
+		self.rank = rank
+		self.cond = threading.Condition()
+		self.jobs = []  # [job, side, deque([(stage, n), ...])]
+		self.pending = []  # likewise, waiting for a slot in jobs
+		self.closing = False
+		self.threads = []
+		for _ in range(nworkers):
+			thr = threading.Thread(target=target, args=(self,))
+			thr.daemon = True
+			thr.start()
+			self.threads.append(thr)
+	
+	def put(self, job, side, tasks, followup=False):
+		with self.cond:
+			for ent in self.jobs + self.pending:
+				if ent[0] is job and ent[1] == side:
+					ent[2].extend(tasks)
+					break
+			else:
+				ent = [job, side, deque(tasks)]
+				if followup or len(self.jobs) < self.maxsize or not self.rank(job)[0]:
+					self.jobs.append(ent)
+				else:
+					self.pending.append(ent)
+			
+			self.cond.notify_all()
+	
+	def _refill(self):
+		"""move the best ranked pending jobs into free slots"""
+		while self.pending and len(self.jobs) < self.maxsize:
+			ent = min(self.pending, key=lambda x: self.rank(x[0]))
+			self.pending.remove(ent)
+			self.jobs.append(ent)
+	
+	def get(self):
+		"""(job, side, stage, n) to do next, or None when closed"""
+		with self.cond:
+			while True:
+				if self.closing:
+					return None
 				
-				next_print += print_interval
-				print('\033[A{}{:6.2f}% @ {:8.2f} MiB/s  {}'.format(
-					prefix, perc, speed, fpath))
+				self._drop_cancelled()
+				self._refill()
+				if self.jobs:
+					break
+				
+				self.cond.wait()
 			
-			data = f.read(512*1024)
-			if not data:
-				break
+			ent = min(self.jobs, key=lambda x: self.rank(x[0]))
+			job, side, tasks = ent
+			stage, n = tasks.popleft()
+			if not tasks:
+				self.jobs.remove(ent)
+				self._refill()
+				self.cond.notify_all()
 			
-			hasher.update(data)
-			fpos += len(data)
+			return job, side, stage, n
 	
-	return base64.b64encode(hasher.digest()
-		).decode('ascii').rstrip('='), time.time() - t0
-
-
-def remove_deleted_folders(dupes):
-	# quickrefresh; drops deleted folders from cache
-	# (single deleted files is not worth)
-	tested = {}
-	ok = {}
-	ng = {}
-	newdupes = []
-	for dupe in dupes:
-		_, fld1, fld2 = dupe
-		for fld in [fld1, fld2]:
-			path = fld.path
-			if path in tested:
-				continue
+	def _drop_cancelled(self):
+		for name in ['jobs', 'pending']:
+			ents = getattr(self, name)
+			keep = []
+			for ent in ents:
+				job, side, tasks = ent
+				if not job.cancelled:
+					keep.append(ent)
+					continue
+				
+				for _, n in tasks:
+					job.forget(side, n)
 			
-			tested[path] = 1
+			if len(keep) != len(ents):
+				setattr(self, name, keep)
+				self.cond.notify_all()
+	
+	def idle(self):
+		with self.cond:
+			return not self.jobs and not self.pending
+	
+	def close(self):
+		"""cancel all queued jobs and stop the workers"""
+		with self.cond:
+			for ent in self.jobs + self.pending:
+				ent[0].cancelled = True
 			
-			if os.path.exists(path):
-				ok[path] = 1
-			else:
-				print('forgetting', path)
-				ng[path] = 1
-		
-		if fld1.path in ok \
-		and fld2.path in ok:
-			newdupes.append(dupe)
+			self._drop_cancelled()
+			self.closing = True
+			self.cond.notify_all()
 	
-	if ng:
-		print("""
-removed {} deleted folders from the cache
-(this removes {} dupes from the cache btw)
-hit ENTER to save and continue, or press CTRL-C
-""".format(len(ng.items()), len(dupes) - len(newdupes)))
-		input()
-
-	return ok, ng, newdupes
+	def join(self):
+		for thr in self.threads:
+			thr.join()
 
 
 class Hashd(object):
-	def __init__(self, sha1_path, dupes):
-		self.sha1_path = sha1_path
+	def __init__(self, hashdb, dupes, nworkers=0, algo='sha1', chunk=HASH_CHUNK):
+		self.hashdb = hashdb
 		self.dupes = dupes
+		self.nworkers = nworkers  # per device; 0 = autodetect
+		self.algo = algo
+		self.chunk = chunk
 		
 		self.mtx = threading.Lock()
 		self.done = Queue()
 		self.workers = {}
+		self.seq = itertools.count()
+		self.abort = threading.Event()
+		self.dev_read = {}  # bytes hashed per device
+		self.dev_names = {}
+		self.speed_at = (time.time(), {})  # previous dev_read
+		self.speed = []
+		self.inflight = 0
+		self.waker = Waker()
 		
-		self.hashtab = {}
-		if os.path.exists(sha1_path):
-			with open(sha1_path, 'rb') as f:
-				for ln in f:
-					sha1, sz, ts, fn = ln.decode('utf-8').split(' ', 3)
-					self.hashtab[fn.rstrip()] = (int(sz), int(ts), sha1)
-		
-		by_folder = {}
-		for fpath, (sz, ts, sha1) in self.hashtab.items():
-			fdir, fname = fpath.rsplit(os.sep, 1)
-			entry = (fname, sz, ts, sha1)
-			try:
-				by_folder[fdir].append(entry)
-			except:
-				by_folder[fdir] = [entry]
+		# files hashed (or being hashed) this session, by inode, so hardlinks
+		# and folders in several pairs are read once; key: [event, hash]
+		self.inodes = {}
 		
-		seen = {}
+		# the pair shown in the tui, and its neighbours to hash when idle
+		self.focused = None
+		self.spec = []
+		self.spec_jobs = {}  # key: speculative job
+		self.spec_mtx = threading.Lock()
+		
+		# cache efficiency; files/bytes which didn't have to be read
+		self.hits = 0
+		self.hit_bytes = 0
+		self.misses = 0
+		self.miss_bytes = 0
+		
+		# files which vanished or couldn't be read
+		self.errors = []
+		
+		# folders of a LazyDupes are attached as they get loaded
+		for fld in dupes.loaded_folders():
+			self.attach(fld)
+		
+		dupes.on_load = self.attach
+	
+	def attach(self, fld):
+		"""
+		merge hashes from the folder (mdw) into the hashdb,
+		and apply the hashdb to the folder
+		"""
 		new_hashes = []
-		for _, fld1, fld2 in dupes:
-			for fld in [fld1, fld2]:
-				if fld in seen:
+		for fname, (sz, ts, sha1) in fld.hashes.items():
+			if sha1 in ['x', '~']:
+				continue  # not a hash (yet)
+			
+			fpath = os.path.join(fld.path, fname)
+			hit = self.hashdb.get(fpath)
+			if not hit or hit[:2] != (sz, ts):
+				# local cache takes precedence over mdw contents
+				new_hashes.append((sha1, sz, ts, fpath))
+		for fname, sz, ts, sha1, samp in self.hashdb.folder(fld.path):
+			fld.hashes[fname] = (sz, ts, sha1 or '~')
+			if samp:
+				fld.samples[fname] = samp
+		
+		self.add_hashes(new_hashes)
+	
+	def terminate(self):
+		"""
+		cancel all jobs (the dupe map is being rebuilt), abort
+		the files being hashed, and wait for the workers to stop
+		"""
+		self.abort.set()
+		with self.spec_mtx:
+			self.spec = []
+		
+		with self.mtx:
+			pools = list(self.workers.values())
+		
+		for pool in pools:
+			pool.close()
+		
+		for pool in pools:
+			pool.join()
+		
+		self.waker.close()
+	
+	def rank(self, job):
+		"""the shown pair first, then whatever H was pressed on, then speculation"""
+		return (job.key != self.focused, job.speculative, job.seq)
+	
+	def focus(self, dupes, idx):
+		"""
+		the tui is showing pair idx of dupes; if it was queued (h/H) it
+		goes before anything else, and its neighbours (largest dupe size
+		first) are sampled when idle, but only hashed in full on h/H
+		"""
+		_, fld1, fld2 = dupes[idx]
+		key = (fld1.path, fld2.path)
+		if key == self.focused:
+			return
+		
+		self.focused = key
+		near = []
+		for dist in range(1, HASH_AHEAD + 1):
+			for n in [idx + dist, idx - dist]:
+				if n < 0 or n >= len(dupes) or not dupes.is_live(n):
 					continue
 				
-				seen[fld] = 1
-				for fname, (sz, ts, sha1) in fld.hashes.items():
-					fpath = os.path.join(fld.path, fname)
-					shab = self.cached_hash(sz, ts, fname)
-					if not shab:
-						# local cache takes precedence over mdw contents
-						new_hashes.append((sha1, sz, ts, fpath))
+				_, nfld1, nfld2 = dupes[n]
+				near.append((get_dupe_size(nfld1, nfld2), n, nfld1, nfld2))
+		
+		near.sort(key=lambda x: (-x[0], x[1]))
+		with self.spec_mtx:
+			self.spec = [(nfld1, nfld2) for _, _, nfld1, nfld2 in near]
+			
+			# speculation for the previous pair is no longer interesting
+			with self.mtx:
+				pools = list(self.workers.values())
+			
+			for pool in pools:
+				with pool.cond:
+					for ent in pool.jobs + pool.pending:
+						if ent[0].speculative and ent[0].key != key:
+							ent[0].cancelled = True
+					
+					pool.cond.notify_all()
+			
+			self.spec_jobs = dict((k, job) for k, job
+				in self.spec_jobs.items() if not job.cancelled)
+		
+		# wake up the workers in case they were idle
+		self.speculate()
+	
+	def speculate(self):
+		"""queue the next neighbour of the focused pair, unless busy"""
+		with self.mtx:
+			pools = list(self.workers.values())
+		
+		if any(not pool.idle() for pool in pools):
+			return
+		
+		with self.spec_mtx:
+			while self.spec and not self.abort.is_set():
+				fld1, fld2 = self.spec.pop(0)
 				try:
-					for fname, sz, ts, sha1 in by_folder[fld.path]:
-						fld.hashes[fname] = (sz, ts, sha1)
+					stf1 = read_folder(fld1.path)
+					stf2 = read_folder(fld2.path)
 				except:
-					pass
+					continue
+				
+				if self.add_pair(fld1, stf1, fld2, stf2, False, True):
+					return
+	
+	def new_job(self, fld1, stf1, fld2, stf2, force, speculative=False):
+		"""PairJob of the files which need hashing, or None"""
+		if self.abort.is_set():
+			return None
 		
-		self.add_hashes(new_hashes)
+		files1, files2 = plan_pair(fld1, stf1, fld2, stf2, force, self.algo)
+		if not files1:
+			return None
+		
+		job = PairJob(fld1, fld2, files1, files2, next(self.seq), speculative)
+		for side in [0, 1]:
+			_, _, fn = job.files[side][0]
+			bpath = fsenc(os.path.join(job.flds[side].path, fn))
+			job.devs[side] = os.lstat(bpath).st_dev
+		
+		return job
 	
-	def terminate(self):
-		for _, worker in self.workers.items():
-			worker.put(None)
-		
-		done = False
-		while not done:
-			done = True
-			time.sleep(0.1)
-			for _, worker in self.workers.items():
-				if not worker.empty():
-					done = False
-	
-	def add(self, fld, stf):
-		sz, ts, fn = stf[0]
-		bpath = fsenc(os.path.join(fld.path, fn))
-		dev_id = os.lstat(bpath).st_dev
-		if dev_id not in self.workers:
-			q = Queue()
-			self.workers[dev_id] = q
-			
-			thr = threading.Thread(target=self.worker, args=(q,))
-			thr.daemon = True
-			thr.start()
+	def add_pair(self, fld1, stf1, fld2, stf2, force, speculative=False):
+		"""
+		compare the size-matched files of the two folder listings;
+		returns False if there was nothing to hash
+		"""
+		# files still being sampled for speculation go on to the full stage
+		if not speculative:
+			job = self.spec_jobs.pop((fld1.path, fld2.path), None)
+			if job:
+				job.speculative = False
+		
+		job = self.new_job(fld1, stf1, fld2, stf2, force, speculative)
+		if not job:
+			return False
+		
+		if speculative:
+			self.spec_jobs[job.key] = job
+		
+		tasks = [('sample', n) for n in range(len(job.files[0]))]
+		self.queue(job, 0, tasks)
+		self.queue(job, 1, tasks)
+		return True
+	
+	def queue(self, job, side, tasks, followup=False):
+		"""hand files of the job to the worker pool of its disk"""
+		dev_id = job.devs[side]
+		with self.mtx:
+			if dev_id not in self.workers:
+				nworkers = self.nworkers or dev_workers(dev_id)
+				self.workers[dev_id] = HashPool(
+					nworkers, HASH_QUEUE, self.worker, self.rank)
+			
+			pool = self.workers[dev_id]
+		
+		pool.put(job, side, tasks, followup)
+	
+	def cached_hash(self, sz, ts, fpath, sr=None):
+		"""
+		returns hash if all attributes match; either by path, or
+		(given a stat result) by device+inode+size+mtime so files
+		that were moved or renamed since are not read again
+		"""
+		ret = None
+		hit = self.hashdb.get(fpath)
+		if hit:
+			csz, cts, csha, cdev, cino, _, _ = hit
+			if sz == csz and ts == cts and (
+				not sr or cino is None or (cdev, cino) == (sr.st_dev, sr.st_ino)
+			):
+				ret = csha
+		
+		if ret and hash_algo(ret) != self.algo:
+			ret = None
+		
+		if not ret and sr:
+			ret = self.hashdb.by_inode(
+				sr.st_dev, sr.st_ino, sr.st_size, mtime_ns(sr), self.algo)
+			
+			if ret:
+				self.add_hashes([(ret, sz, ts, fpath)])
 		
-		self.workers[dev_id].put((fld, stf))
+		with self.mtx:
+			if ret:
+				self.hits += 1
+				self.hit_bytes += sz
+			else:
+				self.misses += 1
+				self.miss_bytes += sz
+		
+		return ret
 	
-	def cached_hash(self, sz, ts, fpath):
-		"""returns hash if all attributes match"""
-		if fpath in self.hashtab:
-			csz, cts, csha = self.hashtab[fpath]
-			if sz == csz and ts == cts:
-				return csha
+	def cached_sample(self, sz, ts, fpath):
+		hit = self.hashdb.get(fpath)
+		if hit and hit[:2] == (sz, ts) and hit[6] and hash_algo(hit[6]) == self.algo:
+			return hit[6]
 		
 		return None
 	
-	def add_hashes(self, sha1_sz_ts_fpath):
-		if not sha1_sz_ts_fpath:
-			return
+	def stats(self):
+		ret = 'hashcache {} hit {:.2f} GiB, {} miss {:.2f} GiB'.format(
+			self.hits, self.hit_bytes / (1024. ** 3),
+			self.misses, self.miss_bytes / (1024. ** 3))
 		
+		if self.errors:
+			ret += '\n{} files could not be hashed:\n'.format(len(self.errors))
+			ret += '\n'.join(self.errors)
+		
+		return ret
+	
+	def oof(self, job, side, n, fpath, ex):
+		"""file couldn't be read; unmark it and keep the error for later"""
+		job.forget(side, n)
 		with self.mtx:
-			with open(self.sha1_path, 'ab+') as f:
-				for item in sha1_sz_ts_fpath:
-					ln = ' '.join(str(x) for x in item) + '\n'
-					f.write(ln.encode('utf-8', ENC_FILTER))
+			self.errors.append('{}: {}'.format(fpath, ex))
+	
+	def add_hashes(self, sha1_sz_ts_fpath):
+		rows = []
+		for sha1, sz, ts, fpath in sha1_sz_ts_fpath:
+			try:
+				sr = os.stat(fsenc(fpath))
+				dev, ino, mtime = sr.st_dev, sr.st_ino, mtime_ns(sr)
+			except:
+				dev = ino = mtime = None  # mdw of another box
 			
-			for sha1, sz, ts, fpath in sha1_sz_ts_fpath:
-				self.hashtab[fpath] = (sz, ts, sha1)
+			rows.append((sha1, sz, ts, fpath, dev, ino, mtime, None))
+		
+		self.hashdb.put(rows)
 	
-	def worker(self, q):
+	def worker(self, pool):
 		while True:
-			task = q.get()
+			task = pool.get()
 			if not task:
 				return
 			
-			fld, stf = task
+			job, side, stage, n = task
+			with self.mtx:
+				self.inflight += 1
 			
-			new_hashes = []
-			for sz, ts, fname in stf:
-				fpath = os.path.join(fld.path, fname)
+			if stage == 'full':
+				self.full_file(job, side, n)
+			else:
+				self.sample_file(job, side, n)
 				with self.mtx:
-					sha = self.cached_hash(sz, ts, fname)
+					job.left[n] -= 1
+					last = not job.left[n]
 				
+				if last and not job.cancelled:
+					self.compare(job, n)
+			
+			with self.mtx:
+				self.inflight -= 1
+			
+			if job.key == self.focused:
+				self.waker.wake()
+			
+			if pool.idle():
+				self.speculate()
+	
+	def sample_file(self, job, side, n):
+		"""
+		first stage; cached or small files get their full hash,
+		the others get their sampled blocks hashed (or reused)
+		"""
+		fld = job.flds[side]
+		sz, ts, fname = job.files[side][n]
+		fpath = os.path.join(fld.path, fname)
+		try:
+			sr = os.stat(fsenc(fpath))
+			sha = self.cached_hash(sz, ts, fpath, sr)
+			samp = None
+			new = False
+			if not sha and sz <= SAMPLE_MIN:
+				sha = self.hash_inode(fpath, sr, job.devs[side])
 				if not sha:
-					sha = self.hashfile(fpath)
-					new_hashes.append((sha, sz, ts, fpath))
+					return job.forget(side, n)
 				
-				fld.hashes[fname] = (sz, ts, sha)
+				new = True
 			
-			self.add_hashes(new_hashes)
+			if not sha:
+				samp = self.cached_sample(sz, ts, fpath)
+				if not samp:
+					samp = self.hashsample(fpath, sz)
+					self.count_read(job.devs[side], SAMPLE_BLOCK * SAMPLE_COUNT)
+					new = True
+		except (IOError, OSError) as ex:
+			return self.oof(job, side, n, fpath, ex)
+		
+		if new:
+			self.hashdb.put([(sha, sz, ts, fpath, sr.st_dev, sr.st_ino, mtime_ns(sr), samp)])
+		
+		job.shas[side][n] = sha
+		job.samps[side][n] = samp
+		if samp:
+			fld.samples[fname] = samp
+		
+		fld.hashes[fname] = (sz, ts, sha or '~')
 	
-	def hashfile(self, fpath):
-		hasher = hashlib.sha1()
-		with open(fsenc(fpath), 'rb', 512*1024) as f:
-			while True:
-				data = f.read(512*1024)
-				if not data:
-					break
+	def compare(self, job, n):
+		"""
+		second stage; full hashes where the samples agree,
+		unless the job is speculative (that's only the samples)
+		"""
+		if job.speculative:
+			return
+		
+		for side in job.unverified(n):
+			self.queue(job, side, [('full', n)], True)
+	
+	def count_read(self, dev_id, nbytes):
+		with self.mtx:
+			self.dev_read[dev_id] = self.dev_read.get(dev_id, 0) + nbytes
+	
+	def busy(self):
+		with self.mtx:
+			pools = list(self.workers.values())
+			if self.inflight:
+				return True
+		
+		return any(not pool.idle() for pool in pools)
+	
+	def queued(self):
+		"""number of files waiting to be hashed, and bytes to read"""
+		with self.mtx:
+			pools = list(self.workers.values())
+		
+		nfiles = 0
+		nbytes = 0
+		for pool in pools:
+			with pool.cond:
+				for job, side, tasks in pool.jobs + pool.pending:
+					if job.cancelled:
+						continue
+					
+					for stage, n in tasks:
+						sz = job.files[side][n][0]
+						if stage == 'sample' and sz > SAMPLE_MIN:
+							sz = SAMPLE_BLOCK * SAMPLE_COUNT
+						
+						nfiles += 1
+						nbytes += sz
+		
+		return nfiles, nbytes
+	
+	def speeds(self):
+		"""[(device name, MiB/s), ...] since the previous call a second ago"""
+		now = time.time()
+		t0, read0 = self.speed_at
+		if now - t0 < 1:
+			return self.speed
+		
+		with self.mtx:
+			read = dict(self.dev_read)
+		
+		self.speed = []
+		for dev_id in sorted(read):
+			nbytes = read[dev_id] - read0.get(dev_id, 0)
+			if nbytes:
+				if dev_id not in self.dev_names:
+					self.dev_names[dev_id] = dev_name(dev_id)
 				
-				hasher.update(data)
+				self.speed.append((self.dev_names[dev_id],
+					nbytes / (1024. * 1024) / (now - t0)))
+		
+		self.speed_at = (now, read)
+		return self.speed
+	
+	def full_file(self, job, side, n):
+		fld = job.flds[side]
+		sz, ts, fname = job.files[side][n]
+		fpath = os.path.join(fld.path, fname)
+		samp = job.samps[side][n]
+		try:
+			sr = os.stat(fsenc(fpath))
+			sha = self.hash_inode(fpath, sr, job.devs[side])
+		except (IOError, OSError) as ex:
+			return self.oof(job, side, n, fpath, ex)
+		
+		if not sha:
+			return job.forget(side, n)  # aborted
+		
+		self.hashdb.put([(sha, sz, ts, fpath, sr.st_dev, sr.st_ino, mtime_ns(sr), samp)])
+		job.shas[side][n] = sha
+		fld.hashes[fname] = (sz, ts, sha)
+	
+	def hash_inode(self, fpath, sr, dev_id=None):
+		"""
+		hashfile, unless the inode was hashed already or is being
+		hashed by another worker; then that hash is used instead
+		"""
+		key = (sr.st_dev, sr.st_ino, sr.st_size, mtime_ns(sr))
+		with self.mtx:
+			ent = self.inodes.get(key)
+			mine = not ent
+			if mine:
+				ent = self.inodes[key] = [threading.Event(), None]
+		
+		if not mine:
+			ent[0].wait()
+			if not ent[1]:
+				# the other worker was aborted or failed; try it here
+				return self.hash_inode(fpath, sr, dev_id)
+			
+			with self.mtx:
+				self.hits += 1
+				self.hit_bytes += sr.st_size
+				self.misses -= 1
+				self.miss_bytes -= sr.st_size
+			
+			return ent[1]
+		
+		try:
+			ent[1] = self.hashfile(fpath, dev_id)
+		finally:
+			if not ent[1]:
+				with self.mtx:
+					del self.inodes[key]
+			
+			ent[0].set()
+		
+		return ent[1]
+	
+	def hashfile(self, fpath, dev_id=None):
+		"""tagged hash of the file, or None if hashd was terminated meanwhile"""
+		hasher = hashlib.new(self.algo)
+		progress = lambda n: self.count_read(dev_id, n)
+		if read_hash(fpath, hasher, self.chunk, self.abort, progress) is None:
+			return None
+		
+		return tag_hash(self.algo, hasher.digest())
+	
+	def hashsample(self, fpath, fsize):
+		"""hash of SAMPLE_COUNT blocks spread evenly from head to tail"""
+		hasher = hashlib.new(self.algo)
+		last = fsize - SAMPLE_BLOCK
+		with open(fsenc(fpath), 'rb') as f:
+			for n in range(SAMPLE_COUNT):
+				f.seek(last * n // (SAMPLE_COUNT - 1))
+				hasher.update(f.read(SAMPLE_BLOCK))
+		
+		return tag_hash(self.algo, hasher.digest())
+
+
+# option: verify-all hashes this much at a time, disk-ordered
+VERIFY_BATCH = 64 * 1024 * 1024 * 1024
+
+
+def verify_all(dupes, hashd):
+	"""
+	headless; hash every size-matched file in every pair, starting
+	with the pairs with the most bytes to reclaim. Pairs are taken
+	in batches of VERIFY_BATCH bytes, and within a batch each spinning
+	disk is read in physical order. Every hash goes into the hashdb as
+	soon as it's done, so it picks up where it left off if interrupted
+	"""
+	print('sorting {} pairs by size'.format(len(dupes)))
+	order = []
+	for n in range(len(dupes)):
+		_, fld1, fld2 = dupes[n]
+		order.append((-get_dupe_size(fld1, fld2), n))
+	
+	order.sort()
+	order = deque(n for _, n in order)
+	nbatch = 0
+	try:
+		while order:
+			jobs = []
+			batch_sz = 0
+			while order and batch_sz < VERIFY_BATCH:
+				n = order.popleft()
+				if not dupes.is_live(n):
+					continue
+				
+				_, fld1, fld2 = dupes[n]
+				try:
+					stf1 = read_folder(fld1.path)
+					stf2 = read_folder(fld2.path)
+					job = hashd.new_job(fld1, stf1, fld2, stf2, False)
+				except (IOError, OSError):
+					continue
+				
+				if job:
+					jobs.append(job)
+					batch_sz += 2 * sum(sz for sz, _, _ in job.files[0])
+			
+			if not jobs:
+				continue
+			
+			nbatch += 1
+			print('batch {}: {} pairs, {:.2f} GiB, {} pairs left'.format(
+				nbatch, len(jobs), batch_sz / (1024. ** 3), len(order)))
+			
+			tasks = []
+			for job in jobs:
+				for n in range(len(job.files[0])):
+					tasks.append((job, 0, 'sample', n))
+					tasks.append((job, 1, 'sample', n))
+			
+			_verify_stage(hashd, tasks, 'sample')
+			
+			tasks = []
+			for job in jobs:
+				for n in range(len(job.files[0])):
+					for side in job.unverified(n):
+						tasks.append((job, side, 'full', n))
+			
+			_verify_stage(hashd, tasks, 'full')
+	except KeyboardInterrupt:
+		print('\ninterrupted; run it again to continue')
+		hashd.terminate()
+
+
+def _verify_stage(hashd, tasks, stage):
+	"""run the tasks with one thread pool per device, printing MiB/s"""
+	if not tasks:
+		return
+	
+	queues = {}
+	for task in tasks:
+		job, side, _, _ = task
+		queues.setdefault(job.devs[side], []).append(task)
+	
+	for dev_id, dev_tasks in queues.items():
+		if dev_rotational(dev_id) is False:
+			continue  # no seeks to avoid, keep biggest first
+		
+		keyed = []
+		for task in dev_tasks:
+			job, side, _, n = task
+			fpath = os.path.join(job.flds[side].path, job.files[side][n][2])
+			try:
+				sr = os.stat(fsenc(fpath))
+			except OSError:
+				continue
+			
+			keyed.append((disk_order(fpath, sr), task))
+		
+		keyed.sort(key=lambda x: x[0])
+		queues[dev_id] = [x[1] for x in keyed]
+	
+	def run(dev_tasks):
+		while not hashd.abort.is_set():
+			try:
+				job, side, _, n = dev_tasks.popleft()
+			except IndexError:
+				return
+			
+			if stage == 'full':
+				hashd.full_file(job, side, n)
+			else:
+				hashd.sample_file(job, side, n)
+	
+	threads = []
+	for dev_id, dev_tasks in queues.items():
+		dev_tasks = deque(dev_tasks)
+		for _ in range(hashd.nworkers or dev_workers(dev_id)):
+			thr = threading.Thread(target=run, args=(dev_tasks,))
+			thr.daemon = True
+			thr.start()
+			threads.append(thr)
+	
+	t0 = t_prev = time.time()
+	with hashd.mtx:
+		read0 = dict(hashd.dev_read)
+	
+	read_prev = read0
+	while True:
+		alive = [thr for thr in threads if thr.is_alive()]
+		if not alive:
+			break
+		
+		# join with a timeout so ^C still gets through
+		alive[0].join(max(0.01, t_prev + 2 - time.time()))
+		now = time.time()
+		if now < t_prev + 2:
+			continue
+		
+		with hashd.mtx:
+			read = dict(hashd.dev_read)
+		
+		speeds = []
+		for dev_id in sorted(queues):
+			nbytes = read.get(dev_id, 0) - read_prev.get(dev_id, 0)
+			speeds.append('{} {:.1f} MiB/s'.format(
+				dev_name(dev_id), nbytes / (1024. * 1024) / max(now - t_prev, 0.001)))
 		
-		b64 = base64.b64encode(hasher.digest())
-		return b64.decode('ascii').rstrip('=')
+		print('{} {}'.format(stage, ', '.join(speeds)))
+		t_prev = now
+		read_prev = read
+	
+	with hashd.mtx:
+		read = dict(hashd.dev_read)
+	
+	nbytes = sum(read.get(x, 0) - read0.get(x, 0) for x in queues)
+	print('{} done; {:.2f} GiB in {:.1f} sec'.format(
+		stage, nbytes / (1024. ** 3), time.time() - t0))
 
 
 def absreal(path):
@@ -1860,49 +4762,159 @@ def main():
 	if len(sys.argv) < 2:
 		print('give me folders to scan as arguments,')
 		print('for example "." for current folder')
+		print()
+		print('options:')
+		print('  -u             discard cache/snapshot/hashes and rescan')
+		print('  -r, --rescan   discard cache and update the snapshot, only')
+		print('                 relisting directories with a new mtime')
+		print('  --text         write snapshot/cache in the old gzip text format')
+		print('  --convert A B  convert snapshot/cache A from binary to text or back')
+		print('  --compact      drop hashes of deleted/modified files from the hashdb')
+		print('  --engine NAME  matcher; "numpy" (default if installed), "index",')
+		print('                 or "pairs" (the slow reference)')
+		print('  --jobs N       match using N processes (0 = one per cpu core)')
+		print('  --stop-df N    don\'t look for dupes through file sizes which are')
+		print('                 in more than N folders (they still add to the score)')
+		print('  --stop-min BYTES')
+		print('                 likewise for files smaller than BYTES')
+		print('  --cross        only pair up folders found in different arguments')
+		print('                 (which of the new dump is already in the archive)')
+		print('  --walkers N    list N directories at once in the folders following')
+		print('                 this option (for network mounts)')
+		print('  --hash NAME    file hash algorithm; sha1 (default), blake2b, md5, ...')
+		print('  --hash-chunk KIB')
+		print('                 read size when hashing (default {})'.format(HASH_CHUNK // 1024))
+		print('  --hash-workers N')
+		print('                 hash N files at once per disk (default: 1 for')
+		print('                 spinning disks, {} for ssd)'.format(HASH_WORKERS_SSD))
+		print('  --verify-all   no ui; hash all size-matched files in the dupe map,')
+		print('                 biggest pairs first (resumes where it was stopped)')
+		print('  --bench-hash FILE')
+		print('                 compare speed and memory use of hashing FILE the old')
+		print('                 and the new way (after any --hash / --hash-chunk)')
+		print('  --bench-match N')
+		print('                 time each --engine on N synthetic folders (after')
+		print('                 any --jobs / --stop-df / --stop-min / --cross)')
 		sys.exit(1)
 	
 	cache_path = os.path.join(tempfile.gettempdir(), 'smf.cache')
 	sha1_path = os.path.join(tempfile.gettempdir(), 'smf.sha1')
+	hashdb_path = os.path.join(tempfile.gettempdir(), 'smf.hashdb')
 	snap_path = os.path.join(tempfile.gettempdir(), 'smf.snap')
 	print('using', cache_path)
-	print('using', sha1_path)
+	print('using', hashdb_path)
 	print('using', snap_path)
 
 	roots = []
-	for root in sys.argv[1:]:
-		if root == '-u':
-			for f in [cache_path, sha1_path, snap_path]:
+	engine = DEFAULT_ENGINE
+	jobs = 1
+	stop_df = 0
+	stop_min = 0
+	cross = False
+	walkers = 1
+	hash_workers = 0
+	algo = 'sha1'
+	chunk = HASH_CHUNK
+	rescan = False
+	textfmt = False
+	verify = False
+	args = sys.argv[1:]
+	while args:
+		arg = args.pop(0)
+		if arg == '-u':
+			for f in [cache_path, snap_path, sha1_path, hashdb_path,
+				hashdb_path + '-wal', hashdb_path + '-shm']:
 				try: os.remove(f)
 				except: pass
+		elif arg in ['-r', '--rescan']:
+			rescan = True
+			try: os.remove(cache_path)
+			except: pass
+		elif arg == '--text':
+			textfmt = True
+		elif arg == '--convert':
+			convert(args.pop(0), args.pop(0))
+			return
+		elif arg == '--compact':
+			HashDB(hashdb_path, sha1_path).compact()
+			return
+		elif arg == '--engine':
+			engine = args.pop(0)
+			if engine not in MATCH_ENGINES:
+				print('--engine must be one of', ', '.join(sorted(MATCH_ENGINES)))
+				sys.exit(1)
+		elif arg == '--jobs':
+			jobs = int(args.pop(0))
+			if jobs <= 0:
+				import multiprocessing
+				jobs = multiprocessing.cpu_count()
+		elif arg == '--stop-df':
+			stop_df = int(args.pop(0))
+		elif arg == '--stop-min':
+			stop_min = int(args.pop(0))
+		elif arg == '--cross':
+			cross = True
+		elif arg == '--walkers':
+			walkers = int(args.pop(0))
+		elif arg == '--hash':
+			algo = args.pop(0)
+			if algo not in hash_algos():
+				print('--hash must be one of', ', '.join(hash_algos()))
+				sys.exit(1)
+		elif arg == '--hash-chunk':
+			chunk = int(args.pop(0)) * 1024
+		elif arg == '--verify-all':
+			verify = True
+		elif arg == '--bench-hash':
+			bench_hash(args.pop(0), chunk, algo)
+			return
+		elif arg == '--bench-match':
+			bench_match(int(args.pop(0)), jobs, stop_df, stop_min, cross)
+			return
+		elif arg == '--hash-workers':
+			hash_workers = int(args.pop(0))
 		else:
-			roots.append(absreal(root))
+			roots.append((absreal(arg), walkers))
 
 	view = 1
 	tui = TUI(absreal(os.getcwd()))
 	
 	dupes = []
 	hashd = None
+	hashdb = HashDB(hashdb_path, sha1_path)
 	while True:
 		if not dupes:
+			# the folders of the previous map are dropped, so their paths too
+			if hashd:
+				hashd.terminate()
+			
+			tui.set_dupes(None)
+			PATHS.reset()
+			
 			gen_time = [0., 0.]
-			if os.path.isfile(cache_path):
+			if os.path.isfile(cache_path) and is_binfile(cache_path):
+				print('loading cache')
+				dupes = LazyDupes(cache_path)
+			elif os.path.isfile(cache_path):
 				print('loading cache')
 				xdupes = load_dupe_map(cache_path)
 				ok, ng, dupes = remove_deleted_folders(xdupes)
 				if len(dupes) != len(xdupes):
-					save_dupe_map(cache_path, dupes)
+					save_dupe_map(cache_path, dupes, textfmt)
+				
+				dupes = DupeList(dupes)
 			else:
-				dupes, gen_time = gen_dupe_map(roots, snap_path)
+				dupes, gen_time = gen_dupe_map(
+					roots, snap_path, engine, jobs, rescan, textfmt, hashdb,
+					stop_df, stop_min, cross)
 				print('saving cache')
-				save_dupe_map(cache_path, dupes)
+				save_dupe_map(cache_path, dupes, textfmt)
+				dupes = DupeList(dupes)
 				tui.gen_time = gen_time
-		
-			if hashd:
-				hashd.terminate()
 			
 			print('mapping hashtab')
-			hashd = Hashd(sha1_path, dupes)
+			hashd = Hashd(hashdb, dupes, hash_workers, algo, chunk)
+			tui.hashd = hashd
 			
 			tui.set_dupes(dupes)
 		
@@ -1910,6 +4922,11 @@ def main():
 			print('you have no dupes ;_;')
 			os.remove(cache_path)
 			return
+		
+		if verify:
+			verify_all(dupes, hashd)
+			print(hashd.stats())
+			return
 
 		if view == 1:
 			rv, extra = tui.foldercomp()
@@ -1924,6 +4941,7 @@ def main():
 				view = 1
 		
 		if rv == 'x':
+			print(hashd.stats())
 			return
 		
 		if rv == 'r':
@@ -1937,36 +4955,8 @@ def main():
 			tui.inverted_hilight = not tui.inverted_hilight
 		
 		if rv in ['h', 'H']:
-			#import pudb; pu.db
-			hashq1 = []
-			hashq2 = []
 			(fld1, stf1), (fld2, stf2) = extra
-			for sz, ts, fn in stf1:
-				hit = next((x for x in stf2 if x[0] == sz and sz > 0), None)
-				if hit:
-					sz2, ts2, fn2 = hit
-					stf2.remove(hit)
-					try:
-						fsz, fts, _ = fld1.hashes[fn]
-						if fsz != sz or fts != ts or rv == 'H':
-							raise Exception()
-					except:
-						fld1.hashes[fn] = (sz, ts, 'x')
-						hashq1.append((sz, ts, fn))
-					
-					try:
-						fsz, fts, _ = fld2.hashes[fn2]
-						if fsz != sz2 or fts != ts2 or rv == 'H':
-							raise Exception()
-					except:
-						fld2.hashes[fn2] = (sz2, ts2, 'x')
-						hashq2.append(hit)
-			
-			if hashq1:
-				hashd.add(fld1, hashq1)
-			
-			if hashq2:
-				hashd.add(fld2, hashq2)
+			hashd.add_pair(fld1, stf1, fld2, stf2, rv == 'H')
 		
 		if rv == 'rm':
 			nuke_path, nuke_files = extra
@@ -2026,7 +5016,8 @@ def main():
 		
 		if need_quickrefresh:
 			ok, ng, dupes = remove_deleted_folders(dupes)
-			save_dupe_map(cache_path, dupes)
+			save_dupe_map(cache_path, dupes, textfmt)
+			dupes = DupeList(dupes)
 			tui.set_dupes(dupes)
 
 
@@ -2062,6 +5053,5 @@ if __name__ == '__main__':
 TODO
 persist y when flipping back to tree
 re_usenet
-match by hash first then filesize
 show hash mismatch count in statusbar
 """
@@ -8,6 +8,8 @@ cat >/dev/null <<EOF
   \033[36mblue folders\033[0m should not appear, let me know if you see one
 EOF
 
+smf_dir=$(cd "$(dirname "$0")" && pwd)
+
 rm -rf /dev/shm/smf
 mkdir -p /dev/shm/smf
 cd /dev/shm/smf
@@ -30,3 +32,27 @@ for n in {1..2}; do gf 2 0 pp1/gc$n/{f1,f2,f3}; done; gf 2 9 pp1/rc1/{f1,f2,f3,f
 #gf 1 0 g1/{f1,f2,f3}
 #gf 1 0 g2/{f1,f2,f3,f4}
 #gf 1 1 g3/{f2,f3,f4}
+
+# identical folders still match when one was hashed with sha1 (mdw)
+# and the other with blake2b (--hash), but not when the hashes differ
+python3 - "$smf_dir" <<'EOF'
+import sys
+sys.path.insert(0, sys.argv[1])
+import smf
+
+sizes = [3 << 20, 5 << 20, 7 << 20]
+def fld(name, algo, tag):
+	ret = smf.Folder('/dev/shm/smf/' + name, sizes)
+	for n, sz in enumerate(sizes):
+		ret.hashes['f{}'.format(n)] = (sz, 0, '{}:{}{}'.format(algo, tag, n))
+	return ret
+
+flds = [fld('sha1', 'sha1', 'a'), fld('b2', 'blake2b', 'a'),
+	fld('sha1x', 'sha1', 'x'), smf.Folder('/dev/shm/smf/none', sizes)]
+
+pairs = set((a.path[13:], b.path[13:]) for _, a, b in smf.match_folders(flds, 'index'))
+assert ('sha1', 'b2') in pairs, pairs
+assert ('sha1', 'sha1x') not in pairs, pairs
+assert ('b2', 'none') in pairs, pairs
+print('mixed-algorithm hashes ok')
+EOF